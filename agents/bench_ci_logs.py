@@ -0,0 +1,70 @@
+"""Benchmark peak RSS of read_ci_logs() on huge logs: python agents/bench_ci_logs.py [GB]"""
+
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import mcp_server as m
+
+LINE = "2024-05-01T12:00:00.123Z   at Object.<anonymous> (app/src/server.js:42:7) request {} took 12ms\n"
+REDRAW = "\r[##########          ] {}% building bundle"
+
+
+def write_lines(path: Path, size: int) -> None:
+    block = "".join(LINE.replace("{}", str(i)) for i in range(10_000))
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(max(1, size // len(block))):
+            f.write(block)
+        f.write("Error: boom\n")
+
+
+def write_redraws(path: Path, size: int) -> None:
+    """A progress bar redrawn with \\r and never a \\n: one line as long as the file."""
+    block = "".join(REDRAW.format(i % 100) for i in range(10_000))
+    with open(path, "w", encoding="utf-8") as f:
+        for _ in range(max(1, size // len(block))):
+            f.write(block)
+        f.write("\nError: boom\n")
+
+
+def measure(log_dir: str) -> None:
+    """Child process: read_ci_logs() over log_dir, then report time, output size and peak RSS."""
+    m.CILOG_DIR = Path(log_dir)
+    m.print = lambda *a, **k: None
+    started = time.perf_counter()
+    out = m.read_ci_logs()
+    seconds = time.perf_counter() - started
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{seconds:.2f}s, {len(out)} chars out, peak RSS {rss_mb:.0f} MB")
+
+
+def run_case(name: str, log_dir: Path, write=None, size: int = 0) -> None:
+    log = log_dir / "runner.log"
+    if write:
+        write(log, size)
+    result = subprocess.run([sys.executable, __file__, "--measure", str(log_dir)], capture_output=True, text=True)
+    print(f"{name:<40} {result.stdout.strip() or result.stderr.strip()}")
+    log.unlink(missing_ok=True)
+
+
+def main() -> None:
+    gb = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    big = int(gb * 1024 ** 3)
+    streamed = m.CI_LOG_CONDENSE_MAX_BYTES // 2
+    with tempfile.TemporaryDirectory() as tmp:
+        log_dir = Path(tmp)
+        run_case("no logs (baseline)", log_dir)
+        run_case(f"{streamed >> 20} MB of lines (streamed)", log_dir, write_lines, streamed)
+        run_case(f"{streamed >> 20} MB of \\r redraws, no \\n (streamed)", log_dir, write_redraws, streamed)
+        run_case(f"{gb:g} GB of lines (head/tail windows)", log_dir, write_lines, big)
+        run_case(f"{gb:g} GB of \\r redraws, no \\n (head/tail)", log_dir, write_redraws, big)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--measure"]:
+        measure(sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,38 @@
+"""Benchmark diff extraction on multi-MB replies: python agents/bench_diff_scan.py [MB]"""
+
+import sys
+import time
+
+import mcp_server as m
+
+# Streamed replies arrive in chunks about this size
+CHUNK = 64
+BLOCK = "```diff\n--- a/f{0}.js\n+++ b/f{0}.js\n@@ -1,3 +1,3 @@\n a\n-b\n+c\n d\n```\nSome prose in between.\n"
+
+
+def timed(fn, *args) -> float:
+    started = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - started
+
+
+def stream(text: str) -> None:
+    sc = m.DiffStreamScanner()
+    for i in range(0, len(text), CHUNK):
+        sc.feed(text[i:i + CHUNK])
+
+
+def main() -> None:
+    top = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    m.print = lambda *a, **k: None  # keep the scan summary out of the timings
+    for mb in (top / 4, top / 2, top):
+        n = int(mb * 1_000_000)
+        fenced = "".join(BLOCK.format(i % 500) for i in range(n // len(BLOCK)))
+        bare = "--- a/big\n+++ b/big\n@@\n" + "".join(f" line {i}\n" for i in range(n // 12))
+        print(f"{mb:5.1f} MB: fenced {timed(m.extract_diff_block, fenced):.3f}s, "
+              f"bare {timed(m.extract_diff_block, bare):.3f}s, "
+              f"streamed in {CHUNK}-char chunks {timed(stream, fenced):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
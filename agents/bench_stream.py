@@ -0,0 +1,36 @@
+"""Benchmark time to patch, streamed vs not, on a fake streaming backend: python agents/bench_stream.py [chunk ms]"""
+
+import sys
+import time
+
+import mcp_server as m
+
+DIFF = "```diff\n--- a/app/server.js\n+++ b/app/server.js\n@@ -1,3 +1,3 @@\n const a = 1;\n-throw boom;\n+return ok;\n const b = 2;\n```\n"
+COMMENTARY = "This change replaces the throw with a return so the request handler completes normally.\n"
+
+
+def time_to_patch(stream: bool) -> tuple:
+    """(seconds until the diff is extracted, chars received) for one vertex_generate() call."""
+    m.VERTEX_STREAM = stream
+    started = time.perf_counter()
+    text = m.vertex_generate("fix the failing test")
+    diff = m.extract_diff_block(text)
+    assert diff == DIFF[len("```diff\n"):-len("```\n")].strip()
+    return time.perf_counter() - started, len(text)
+
+
+def main() -> None:
+    chunk_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 20
+    m.print = lambda *a, **k: None
+    m.LLM_METRICS_FILE = m.LLM_LATENCY_FILE = ""
+    for lines in (10, 50, 200):
+        reply = "Here is the fix:\n" + DIFF + COMMENTARY * lines
+        m._BACKEND = m.SyntheticBackend(reply, latency_ms=300, jitter=0, failure_rate=0, seed=0, chunk_ms=chunk_ms)
+        full_s, full_chars = time_to_patch(False)
+        streamed_s, streamed_chars = time_to_patch(True)
+        print(f"{len(reply):>6}-char reply, {chunk_ms:g} ms/chunk: whole {full_s:.2f}s ({full_chars} chars), "
+              f"streamed {streamed_s:.2f}s ({streamed_chars} chars read)")
+
+
+if __name__ == "__main__":
+    main()
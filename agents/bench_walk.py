@@ -0,0 +1,61 @@
+"""Benchmark file discovery on a tree with a large node_modules: python agents/bench_walk.py [node_modules files]"""
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import mcp_server as m
+
+
+def build_tree(root: Path, n_vendored: int) -> None:
+    """A small app (sources, manifests, workflows, k8s) plus n_vendored files under app/node_modules."""
+    for i in range(200):
+        for rel in (f"app/src/m{i % 20}/f{i}.js", f"app/src/m{i % 20}/f{i}.test.ts", f"agents/p{i % 10}/a{i}.py"):
+            (root / rel).parent.mkdir(parents=True, exist_ok=True)
+            (root / rel).write_text("x\n")
+    for rel in ("package.json", "app/package.json", "app/package-lock.json", "README.md", "Dockerfile",
+                ".github/workflows/ci.yml", "k8s/base/deploy.yaml"):
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel).write_text("x\n")
+    per_pkg = 50
+    for i in range(n_vendored):
+        pkg = root / "app" / "node_modules" / f"pkg{i // per_pkg}" / ("lib" if i % 2 else "")
+        if i % per_pkg < 2:
+            pkg.mkdir(parents=True, exist_ok=True)
+        (pkg / (f"i{i}.js" if i % 5 else "package.json")).write_text("x\n")
+
+
+def rglob_files(root: Path) -> list:
+    """The previous implementation: one rglob per pattern, de-duplicated in pattern order."""
+    seen: set = set()
+    files = []
+    for patt in m.CONTEXT_PATTERNS:
+        for p in root.rglob(patt):
+            rel = p.relative_to(root)
+            if rel not in seen and p.is_file():
+                seen.add(rel)
+                files.append(rel)
+    return files
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - started, out
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        seconds, _ = timed(build_tree, root, n)
+        print(f"built tree with {n} node_modules files in {seconds:.1f}s")
+        old_s, old = timed(rglob_files, root)
+        new_s, new = timed(lambda: m.match_files(m.walk_files(root), m.CONTEXT_PATTERNS))
+        print(f"rglob per pattern: {old_s:.3f}s ({len(old)} files, node_modules included)")
+        print(f"pruned walk + one matcher: {new_s:.3f}s ({len(new)} files)")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,10 +6,25 @@ import os
 import sys
 import re
 import json
+import signal
 import textwrap
 import subprocess
+import functools
+import hashlib
+import tempfile
+import shutil
+import threading
+import time
+import random
+from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import xml.etree.ElementTree as ET
+import ast
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Tuple
 
 # When DISABLE_HEAL_PATCH=1, skip applying LLM patches
 DISABLE_HEAL_PATCH = os.environ.get("DISABLE_HEAL_PATCH", "0") == "1"
@@ -23,7 +38,7 @@ Env required:
 
 Behavior:
   1) Collect junit.xml and any logs in ./ci-logs
-  2) Collect important repo files (relative rglob)
+  2) Collect important repo files (git index listing, or one pruned walk)
   3) Ask Gemini to propose a unified diff patch
   4) Apply patch, run npm ci && npm test
   5) If green, push branch `auto-fix/<sha8>`
@@ -56,18 +71,47 @@ def run(cmd: List[str], cwd: Path | None = None, check: bool = True) -> subproce
     )
 
 
-def run_cap(cmd: List[str], cwd: Path | None = None, env: dict | None = None) -> Tuple[int, str]:
-    """Run a command, capturing stdout+stderr (merged)."""
+def run_cap(cmd: List[str], cwd: Path | None = None, env: dict | None = None,
+            cancel: threading.Event | None = None, input: str | None = None) -> Tuple[int, str]:
+    """
+    Run a command, capturing stdout+stderr (merged), with `input` on stdin.
+    If `cancel` gets set, the process and everything it spawned are killed
+    (-9); cancellable runs take no input.
+    """
     print(f"$ {' '.join(cmd)}")
-    p = subprocess.run(
+    if cancel is None:
+        p = subprocess.run(
+            cmd,
+            cwd=str(cwd) if cwd else None,
+            input=input,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+        )
+        return p.returncode, p.stdout
+    proc = subprocess.Popen(
         cmd,
         cwd=str(cwd) if cwd else None,
         text=True,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
         env=env,
+        # its own process group: npm/npx leave node grandchildren holding the pipe
+        start_new_session=True,
     )
-    return p.returncode, p.stdout
+    while True:
+        try:
+            out, _ = proc.communicate(timeout=0.5)
+            return proc.returncode, out
+        except subprocess.TimeoutExpired:
+            if cancel.is_set():
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                out, _ = proc.communicate()
+                return -9, out
 
 
 def ensure_git_identity() -> None:
@@ -82,94 +126,1596 @@ def current_sha_short() -> str:
 
 # -------- file gathering
 
+# Patterns follow rglob semantics: each one may match at any depth below ROOT.
+CONTEXT_PATTERNS = [
+    "package.json", "package-lock.json",
+    "app/package.json", "app/package-lock.json",
+    "app/**/*.js", "app/**/*.ts", "app/**/*.tsx", "app/**/*.jsx",
+    "app/**/*.json", "app/**/*.yaml", "app/**/*.yml", "app/**/*.md",
+    "agents/**/*.py",
+    ".github/workflows/*.yml", ".github/workflows/*.yaml",
+    "k8s/**/*.yaml", "k8s/**/*.yml",
+    "Dockerfile", "app/Dockerfile", "README.md",
+]
+
+# Directories never worth descending into (vendored deps, VCS internals, caches).
+# Extend with CONTEXT_PRUNE_DIRS="dir1,dir2".
+PRUNE_DIRS = {
+    ".git", "node_modules", "__pycache__", ".venv", "venv",
+    ".pytest_cache", ".mypy_cache", ".ruff_cache", ".tox", ".nox",
+} | {d.strip() for d in os.environ.get("CONTEXT_PRUNE_DIRS", "").split(",") if d.strip()}
+
+
+def _glob_to_regex(patt: str) -> str:
+    """Translate one rglob-style pattern into a regex over posix relative paths."""
+    out = []
+    i = 0
+    while i < len(patt):
+        if patt.startswith("**/", i):
+            out.append("(?:[^/]+/)*")
+            i += 3
+        elif patt[i] == "*":
+            out.append("[^/]*")
+            i += 1
+        elif patt[i] == "?":
+            out.append("[^/]")
+            i += 1
+        else:
+            out.append(re.escape(patt[i]))
+            i += 1
+    # rglob matches the pattern relative to any directory below ROOT
+    return "(?:[^/]+/)*" + "".join(out)
+
+
+def compile_patterns(patterns: List[str]) -> re.Pattern:
+    """
+    Compile all patterns into one alternation; match.lastgroup is the index
+    ("p<N>") of the FIRST pattern that matches, which is what decides ordering.
+    """
+    alts = [f"(?P<p{i}>{_glob_to_regex(p)})" for i, p in enumerate(patterns)]
+    return re.compile("|".join(alts))
+
+
+def walk_files(root: Path, prune: set[str] | None = None):
+    """Yield posix relative paths of regular files below root, pruning ignored dirs up front."""
+    prune = PRUNE_DIRS if prune is None else prune
+    stack = [("", str(root))]
+    while stack:
+        prefix, path = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for e in entries:
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    if e.name not in prune:
+                        subdirs.append((prefix + e.name + "/", e.path))
+                elif e.is_file():
+                    yield prefix + e.name
+            except OSError:
+                continue
+        # reversed so the stack pops directories in sorted order
+        stack.extend(reversed(subdirs))
+
+
+def match_files(candidates, patterns: List[str]) -> List[Path]:
+    """
+    Bucket candidate posix paths by the first pattern they match and return them
+    concatenated in pattern order (same ordering + de-dup as one rglob per pattern).
+    """
+    rx = compile_patterns(patterns)
+    buckets: List[List[Path]] = [[] for _ in patterns]
+    for rel in candidates:
+        m = rx.fullmatch(rel)
+        if m:
+            buckets[int(m.lastgroup[1:])].append(Path(rel))
+    return [p for b in buckets for p in b]
+
+
+# File discovery backend: "git" lists tracked files from the index (respects
+# .gitignore, skips untracked build output), "walk" scans the filesystem,
+# "auto" uses git when ROOT is a repository and falls back to the walk.
+CONTEXT_DISCOVERY = os.environ.get("CONTEXT_DISCOVERY", "auto").lower()
+# Optional tree-ish (e.g. a failing SHA) to list files from instead of the index
+CONTEXT_TREEISH = os.environ.get("CONTEXT_TREEISH", "")
+
+
+@functools.lru_cache(maxsize=8)
+def git_list_files(tree_ish: str = "") -> Tuple[str, ...] | None:
+    """Tracked files (posix, relative) from `git ls-files -z` or `git ls-tree` at tree_ish; None outside git."""
+    if tree_ish:
+        cmd = ["git", "ls-tree", "-r", "-z", "--name-only", tree_ish]
+    else:
+        cmd = ["git", "ls-files", "-z"]
+    code, out = run_cap(cmd, cwd=ROOT)
+    if code != 0:
+        return None
+    return tuple(f for f in out.split("\0") if f)
+
+
+def candidate_files(tree_ish: str = ""):
+    """Yield candidate relative paths from the configured discovery backend."""
+    if CONTEXT_DISCOVERY in ("auto", "git"):
+        listed = git_list_files(tree_ish)
+        if listed is not None:
+            for rel in listed:
+                # tracked vendored trees (e.g. a committed node_modules) are still pruned
+                if not PRUNE_DIRS.intersection(rel.split("/")[:-1]):
+                    yield rel
+            return
+        print("git file listing unavailable; falling back to filesystem walk")
+    yield from walk_files(ROOT)
+
+
+def discover_files(patterns: List[str], tree_ish: str = "") -> List[Path]:
+    """Relative paths matching patterns, in pattern order, from a single listing pass."""
+    return match_files(candidate_files(tree_ish), patterns)
+
+
 def important_files() -> List[Path]:
     """
     Return a list of RELATIVE file paths to include in context.
-    Uses rglob with only relative patterns to avoid pathlib NotImplementedError.
-    """
-    patterns = [
-        "package.json", "package-lock.json",
-        "app/package.json", "app/package-lock.json",
-        "app/**/*.js", "app/**/*.ts", "app/**/*.tsx", "app/**/*.jsx",
-        "app/**/*.json", "app/**/*.yaml", "app/**/*.yml", "app/**/*.md",
-        "agents/**/*.py",
-        ".github/workflows/*.yml", ".github/workflows/*.yaml",
-        "k8s/**/*.yaml", "k8s/**/*.yml",
-        "Dockerfile", "app/Dockerfile", "README.md",
-    ]
-    seen: set[Path] = set()
-    files: List[Path] = []
-    for patt in patterns:
-        for p in ROOT.rglob(patt):
+    One listing (git index or pruned walk) matched against all CONTEXT_PATTERNS at once.
+    """
+    return discover_files(CONTEXT_PATTERNS, CONTEXT_TREEISH)
+
+
+# -------- prompt budget
+
+# Input context windows (tokens) by model-name prefix; longest prefix wins.
+MODEL_CONTEXT_TOKENS = {
+    "gemini-1.0-pro": 32_760,
+    "gemini-1.5-flash": 1_048_576,
+    "gemini-1.5-pro": 2_097_152,
+    "gemini-2.0-flash": 1_048_576,
+    "gemini-2.5": 1_048_576,
+    "gemini": 1_000_000,
+}
+# Total tokens spent on logs + code + deployment; clamped to the model window.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "350000"))
+# Held back for the system rules, headers and the model's answer.
+PROMPT_RESERVE_TOKENS = int(os.environ.get("PROMPT_RESERVE_TOKENS", "16000"))
+# Lowest-priority sections, the first to give up tokens when a prompt is over the model's limit
+PROMPT_SHRINKABLE = ("logs", "code")
+# Shrink level i keeps 1 - i/PROMPT_SHRINK_LEVELS of the shrinkable sections
+PROMPT_SHRINK_LEVELS = int(os.environ.get("PROMPT_SHRINK_LEVELS", "8"))
+# Sections in allocation order, with the share of the total each is guaranteed.
+# Whatever a section leaves unused rolls over to the ones after it.
+PROMPT_SHARES = {"deploy": 0.05, "failures": 0.05, "logs": 0.30, "code": 0.55, "focus": 0.05}
+# Per-item caps inside a section
+PROMPT_FOCUS_FILES = int(os.environ.get("PROMPT_FOCUS_FILES", "20"))
+PROMPT_LOG_FILE_TOKENS = int(os.environ.get("PROMPT_LOG_FILE_TOKENS", "32000"))
+PROMPT_CODE_FILE_TOKENS = int(os.environ.get("PROMPT_CODE_FILE_TOKENS", "30000"))
+
+CHARS_PER_TOKEN = 4
+TRUNCATED = "\n[...truncated...]\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast local estimate (~4 chars/token for code and English logs); no tokenizer round-trip."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Cut text so it (including the truncation marker) fits in `tokens`."""
+    if estimate_tokens(text) <= tokens:
+        return text
+    keep = max(0, tokens * CHARS_PER_TOKEN - len(TRUNCATED))
+    return text[:keep] + TRUNCATED if keep else ""
+
+
+def model_context_tokens(model_name: str) -> int:
+    best = ""
+    for prefix in MODEL_CONTEXT_TOKENS:
+        if model_name.startswith(prefix) and len(prefix) > len(best):
+            best = prefix
+    return MODEL_CONTEXT_TOKENS.get(best, 128_000)
+
+
+class PromptBudget:
+    """
+    Splits one token budget across prompt sections by priority. Sections are
+    built in PROMPT_SHARES order; each may use its share plus the unused
+    remainder of earlier sections, so the sum can never exceed the total.
+    """
+
+    def __init__(self, total: int, shares: dict | None = None):
+        self.total = total
+        self.shares = dict(shares or PROMPT_SHARES)
+        self.used: dict = {}
+        self._carry = 0
+
+    @classmethod
+    def for_model(cls, model_name: str, cap: int = 0) -> "PromptBudget":
+        window = model_context_tokens(model_name) - PROMPT_RESERVE_TOKENS
+        total = min(PROMPT_TOKEN_BUDGET, window)
+        return cls(max(0, min(total, cap) if cap else total))
+
+    def share(self, section: str) -> int:
+        """`section`'s own share, without anything rolled over from earlier sections."""
+        return int(self.total * self.shares.get(section, 0))
+
+    def allot(self, section: str) -> int:
+        """Tokens `section` may still use."""
+        return self.share(section) + self._carry
+
+    def spend(self, section: str, text: str) -> str:
+        """Record a built section (truncating it to its allotment as a last resort) and roll over the rest."""
+        allot = self.allot(section)
+        text = truncate_to_tokens(text, allot)
+        self.used[section] = estimate_tokens(text)
+        self._carry = allot - self.used[section]
+        return text
+
+    def shrunk(self, scale: float) -> "PromptBudget":
+        """Same budget with the PROMPT_SHRINKABLE allotments scaled by `scale`; other sections keep their tokens."""
+        fixed = sum(v for k, v in self.shares.items() if k not in PROMPT_SHRINKABLE)
+        total = int(self.total * (fixed + (1 - fixed) * scale))
+        if total <= 0:
+            return PromptBudget(0, self.shares)
+        shares = {
+            k: v * (scale if k in PROMPT_SHRINKABLE else 1) * self.total / total
+            for k, v in self.shares.items()
+        }
+        return PromptBudget(total, shares)
+
+
+# -------- on-disk cache
+
+class DiskCache:
+    """
+    Small content-addressed cache: one file per key under `root`, LRU by mtime
+    (refreshed on every hit), trimmed to `max_bytes` by evict(). Writes go
+    through a temp file + os.replace so concurrent runs never see torn entries.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> bytes | None:
+        p = self._path(key)
+        try:
+            data = p.read_bytes()
+            os.utime(p)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        p = self._path(key)
+        try:
+            p.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=p.parent, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, p)
+        except OSError as e:
+            print(f"cache write failed for {key}: {e}")
+
+    def evict(self) -> int:
+        """Drop least-recently-used entries until the cache fits max_bytes; returns entries removed."""
+        entries = []
+        total = 0
+        for dirpath, _, names in os.walk(self.root):
+            for n in names:
+                fp = os.path.join(dirpath, n)
+                try:
+                    st = os.stat(fp)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fp))
+                total += st.st_size
+        removed = 0
+        for _, size, fp in sorted(entries):
+            if total <= self.max_bytes:
+                break
             try:
-                rel = p.relative_to(ROOT)
-            except Exception:
+                os.unlink(fp)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+# Rendered `=== path ===` blobs for read_code_context(); CONTEXT_CACHE_DIR=off disables
+CONTEXT_CACHE_DIR = os.environ.get("CONTEXT_CACHE_DIR", str(Path.home() / ".cache" / "agentic-heal" / "context"))
+CONTEXT_CACHE_MAX_BYTES = int(os.environ.get("CONTEXT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Bump when the rendering of a blob changes so stale entries are never served
+CONTEXT_RENDER_VERSION = "1"
+
+
+def context_cache() -> DiskCache | None:
+    if not CONTEXT_CACHE_DIR or CONTEXT_CACHE_DIR.lower() in ("0", "off", "none"):
+        return None
+    return DiskCache(Path(CONTEXT_CACHE_DIR), CONTEXT_CACHE_MAX_BYTES)
+
+
+def git_blob_ids() -> dict:
+    """Map relative path -> index blob id for tracked files whose worktree copy is unmodified."""
+    code, out = run_cap(["git", "ls-files", "-s", "-z"], cwd=ROOT)
+    if code != 0:
+        return {}
+    ids = {}
+    for rec in out.split("\0"):
+        meta, sep, path = rec.partition("\t")
+        if sep:
+            ids[path] = meta.split()[1]
+    code, out = run_cap(["git", "ls-files", "-m", "-z"], cwd=ROOT)
+    if code == 0:
+        for path in out.split("\0"):
+            ids.pop(path, None)
+    return ids
+
+
+def blob_cache_key(rel: Path, blob_ids: dict, *params) -> str | None:
+    """Key a rendered blob by git blob id, or by mtime+size+inode outside git."""
+    posix = rel.as_posix()
+    ident = blob_ids.get(posix)
+    if not ident:
+        try:
+            st = (ROOT / rel).stat()
+        except OSError:
+            return None
+        ident = f"stat:{st.st_mtime_ns}:{st.st_size}:{st.st_ino}"
+    raw = "|".join([CONTEXT_RENDER_VERSION, ident, posix, *map(str, params)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# -------- failure-anchored ranking
+
+# path[:line[:col]] as printed by jest/node stack traces, eslint, tsc, webpack/vite...
+ANCHOR_RE = re.compile(
+    r"(?P<path>(?:[\w.@~-]+/)*[\w.@~-]+\.(?:jsx?|tsx?|mjs|cjs|py|json|ya?ml))"
+    r"(?:[:(](?P<line>\d+))?"
+)
+# ...and Python tracebacks: File "agents/x.py", line 12
+PY_ANCHOR_RE = re.compile(r'File "(?P<path>[^"]+)", line (?P<line>\d+)')
+
+LOCKFILES = {"package-lock.json", "yarn.lock", "pnpm-lock.yaml", "npm-shrinkwrap.json"}
+
+
+def extract_anchors(text: str) -> dict:
+    """Map each file path mentioned in failure output to the set of line numbers cited for it."""
+    anchors: dict = {}
+    for rx in (ANCHOR_RE, PY_ANCHOR_RE):
+        for m in rx.finditer(text):
+            path = re.sub(r"^(?:\./)+", "", m.group("path"))
+            if "node_modules/" in path:
+                continue
+            lines = anchors.setdefault(path, set())
+            if m.group("line"):
+                lines.add(int(m.group("line")))
+    return anchors
+
+
+def _same_file(anchor: str, posix: str) -> bool:
+    """Anchors may be absolute runner paths, repo-relative, or relative to app/."""
+    return anchor == posix or anchor.endswith("/" + posix) or ("/" in anchor and posix.endswith("/" + anchor))
+
+
+def anchor_lines(rel: Path, anchors: dict) -> set:
+    """Line numbers cited for rel across all anchors."""
+    posix = rel.as_posix()
+    hit: set = set()
+    for path, lines in anchors.items():
+        if _same_file(path, posix):
+            hit |= lines
+    return hit
+
+
+def score_file(rel: Path, anchors: dict) -> float:
+    posix = rel.as_posix()
+    score = 0.0
+    for path, lines in anchors.items():
+        if _same_file(path, posix):
+            score += 10 + min(len(lines), 5) * 2
+        elif path.rsplit("/", 1)[-1] == rel.name:
+            score += 4
+        elif "/" in path and rel.parent.as_posix() != "." and path.rsplit("/", 1)[0].endswith(rel.parent.as_posix()):
+            score += 1
+    if rel.name in LOCKFILES:
+        score -= 5
+    return score
+
+
+def rank_files(files: List[Path], anchors: dict) -> List[Path]:
+    """Most failure-relevant first; discovery order breaks ties (sort is stable)."""
+    return sorted(files, key=lambda rel: -score_file(rel, anchors))
+
+
+# -------- log condensation
+
+ANSI_RE = re.compile(r"\x1b\[[0-9;?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)")
+# GitHub runner / kubectl --timestamps prefix
+LEADING_TS_RE = re.compile(r"^\ufeff?\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?(?:Z|[+-]\d{2}:?\d{2})?\s+")
+# Volatile tokens, masked in the comparison key so otherwise identical lines collapse together
+VOLATILE_RES = [
+    (re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:[.,]\d+)?Z?"), "<ts>"),
+    (re.compile(r"\b[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\b", re.I), "<uuid>"),
+    (re.compile(r"\b0x[0-9a-f]{6,}\b", re.I), "<addr>"),
+    (re.compile(r"\b\d+(?:\.\d+)?\s?(?:ms|s)\b"), "<dur>"),
+]
+# Lines that never help diagnose a failure
+NOISE_RE = re.compile(
+    r"^\s*(?:npm (?:WARN (?:deprecated|old lockfile)|notice)\b"
+    r"|##\[(?:group|endgroup)\]"
+    r"|[\[(]?[#=>.\-\s░▒▓█⸨⸩|]{10,}[\])]?\s*(?:\d+%)?\s*$"
+    r"|(?:Downloading|Extracting|Pulling fs layer|Waiting|Verifying Checksum|Download complete)\b.*\d+%?\s*$)"
+)
+STACK_FRAME_RE = re.compile(r'^\s+(?:at \S|File ")')
+# Frames kept from each consecutive run of stack frames
+LOG_STACK_KEEP = int(os.environ.get("LOG_STACK_KEEP", "8"))
+# Above this size a log is condensed from its head/tail windows only, not streamed whole
+CI_LOG_CONDENSE_MAX_BYTES = int(os.environ.get("CI_LOG_CONDENSE_MAX_BYTES", str(256 * 1024 * 1024)))
+# Longest line handed to the condenser; the rest of a longer line is dropped as it is read
+LOG_LINE_MAX_CHARS = int(os.environ.get("LOG_LINE_MAX_CHARS", str(64 * 1024)))
+# Characters read per chunk when streaming a log
+LOG_READ_CHUNK = 1024 * 1024
+
+
+def _normalized(lines: Iterable[str], stats: dict) -> Iterator[str]:
+    for raw in lines:
+        stats["bytes_in"] = stats.get("bytes_in", 0) + len(raw)
+        line = raw.rstrip("\r\n")
+        if "\r" in line:
+            # progress bars redraw with \r; only the final state matters
+            line = line.rstrip("\r").rsplit("\r", 1)[-1]
+        if "\x1b" in line:
+            line = ANSI_RE.sub("", line)
+        if line[:1].isdigit() or line[:1] == "\ufeff":
+            line = LEADING_TS_RE.sub("", line)
+        if NOISE_RE.match(line):
+            continue
+        yield line.rstrip()
+
+
+def _squeeze(line: str) -> str:
+    """A partial line reduced to what _normalized() would keep of it: the last \\r redraw, capped in length."""
+    crs = len(line) - len(line.rstrip("\r"))
+    body = line[:len(line) - crs]
+    if "\r" in body:
+        body = body.rsplit("\r", 1)[-1]
+    return body[:LOG_LINE_MAX_CHARS] + "\r" * crs
+
+
+def _bounded_lines(f, stats: dict) -> Iterator[str]:
+    """
+    Lines of text file f, read in LOG_READ_CHUNK pieces and split on \\n. A line
+    is squeezed while it is still being read, so a progress bar redrawn with
+    \\r (and no \\n) for megabytes is never held whole.
+    """
+    pending = ""
+    while True:
+        chunk = f.read(LOG_READ_CHUNK)
+        if not chunk:
+            break
+        parts = chunk.split("\n")
+        for i, part in enumerate(parts):
+            raw = pending + part
+            pending = _squeeze(raw)
+            # _normalized() counts what it is handed; count what was squeezed away here
+            stats["bytes_in"] = stats.get("bytes_in", 0) + len(raw) - len(pending)
+            if i < len(parts) - 1:
+                yield pending + "\n"
+                pending = ""
+    if pending:
+        yield pending
+
+
+def _volatile_key(line: str) -> str:
+    """line with volatile tokens masked; only used to compare lines, never emitted."""
+    for rx, repl in VOLATILE_RES:
+        line = rx.sub(repl, line)
+    return line
+
+
+def _collapse_runs(lines: Iterable[str]) -> Iterator[str]:
+    """Runs of lines equal up to volatile tokens become their first original line plus `(xN)`."""
+    first, key, n = None, None, 0
+    for line in lines:
+        k = _volatile_key(line)
+        if k == key:
+            n += 1
+            continue
+        if first is not None:
+            yield first if n == 1 else f"{first} (x{n})"
+        first, key, n = line, k, 1
+    if first is not None:
+        yield first if n == 1 else f"{first} (x{n})"
+
+
+def _fold_frames(lines: Iterable[str]) -> Iterator[str]:
+    run = 0
+    for line in lines:
+        if STACK_FRAME_RE.match(line):
+            run += 1
+            if run <= LOG_STACK_KEEP:
+                yield line
+            continue
+        if run > LOG_STACK_KEEP:
+            yield f"    ... {run - LOG_STACK_KEEP} more frames"
+        run = 0
+        yield line
+    if run > LOG_STACK_KEEP:
+        yield f"    ... {run - LOG_STACK_KEEP} more frames"
+
+
+def condense_lines(lines: Iterable[str], stats: dict | None = None) -> Iterator[str]:
+    """
+    Streaming log condenser: strips ANSI/progress redraws and timestamps,
+    drops known noise, collapses runs of lines that differ only in volatile
+    tokens into `(xN)` and folds long stack traces. Byte counts accumulate in stats.
+    """
+    stats = stats if stats is not None else {}
+    for line in _fold_frames(_collapse_runs(_normalized(lines, stats))):
+        stats["bytes_out"] = stats.get("bytes_out", 0) + len(line) + 1
+        yield line
+
+
+def print_condense_stats(what: str, stats: dict) -> None:
+    if stats.get("bytes_in"):
+        saved = stats["bytes_in"] - stats.get("bytes_out", 0)
+        print(f"log condensation ({what}): {stats['bytes_in']} -> {stats.get('bytes_out', 0)} bytes, {saved} saved")
+
+
+def condense_text(text: str, stats: dict | None = None) -> str:
+    return "\n".join(condense_lines(text.splitlines(), stats))
+
+
+def read_condensed_log(path: Path, head_chars: int, tail_chars: int, stats: dict | None = None) -> str:
+    """
+    Stream path through condense_lines(), keeping the first head_chars and a
+    rolling last tail_chars of condensed output; memory stays bounded, long
+    lines included (see _bounded_lines). Logs over CI_LOG_CONDENSE_MAX_BYTES
+    are condensed from their raw head/tail only.
+    """
+    stats = stats if stats is not None else {}
+    if path.stat().st_size > CI_LOG_CONDENSE_MAX_BYTES:
+        return condense_text(read_head_tail(path, head_chars, tail_chars), stats)
+    head: List[str] = []
+    head_len = 0
+    tail: deque = deque()
+    tail_len = 0
+    elided = 0
+    with open(path, encoding="utf-8", errors="replace", newline="\n") as f:
+        for line in condense_lines(_bounded_lines(f, stats), stats):
+            if head_len + len(line) < head_chars and not tail:
+                head.append(line)
+                head_len += len(line) + 1
                 continue
-            if rel.is_dir():
+            tail.append(line)
+            tail_len += len(line) + 1
+            while tail_len > tail_chars and tail:
+                tail_len -= len(tail.popleft()) + 1
+                elided += 1
+    out = "\n".join(head)
+    if elided:
+        out += f"\n[... {elided} condensed lines elided ...]"
+    if tail:
+        out += "\n" + "\n".join(tail)
+    return out + "\n"
+
+
+# -------- JUnit
+
+# Failure message/stack kept per testcase (after stack folding)
+JUNIT_MESSAGE_CHARS = int(os.environ.get("JUNIT_MESSAGE_CHARS", "2000"))
+
+
+def is_junit_report(path: Path) -> bool:
+    if path.suffix.lower() != ".xml":
+        return False
+    try:
+        with open(path, "rb") as f:
+            return b"<testsuite" in f.read(4096)
+    except OSError:
+        return False
+
+
+def parse_junit_failures(path: Path) -> List[dict]:
+    """
+    Stream a JUnit report with iterparse, keeping only failing/erroring testcases.
+    Finished elements are detached from their parent as we go, so memory does
+    not grow with the number of passing tests.
+    """
+    failures: List[dict] = []
+    stack: list = []
+    try:
+        for event, elem in ET.iterparse(str(path), events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
                 continue
-            if rel in seen:
+            stack.pop()
+            if elem.tag == "testcase":
+                for child in elem:
+                    if child.tag in ("failure", "error"):
+                        detail = condense_text(((child.get("message") or "") + "\n" + (child.text or "")).strip())
+                        failures.append({
+                            "kind": child.tag,
+                            "classname": elem.get("classname", ""),
+                            "name": elem.get("name", ""),
+                            "time": elem.get("time", ""),
+                            "message": detail[:JUNIT_MESSAGE_CHARS],
+                        })
+                        break
+            if elem.tag in ("testcase", "testsuite"):
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+    except (ET.ParseError, OSError) as e:
+        print(f"junit parse stopped early for {path}: {e}")
+    return failures
+
+
+def junit_reports() -> List[Path]:
+    reports = [APP_DIR / "junit.xml"]
+    if CILOG_DIR.exists():
+        reports += sorted(p for p in CILOG_DIR.rglob("*.xml") if p.is_file())
+    return [p for p in reports if p.is_file() and is_junit_report(p)]
+
+
+def read_failures() -> str:
+    """Compact FAILURES section from every JUnit report (app/junit.xml and ci-logs), de-duplicated."""
+    seen = set()
+    out: List[str] = []
+    for report in junit_reports():
+        for f in parse_junit_failures(report):
+            key = (f["classname"], f["name"])
+            if key in seen:
                 continue
-            seen.add(rel)
-            files.append(rel)
-    return files
+            seen.add(key)
+            out.append(f"- [{f['kind']}] {f['classname']} :: {f['name']} ({f['time'] or '?'}s)")
+            out.extend("    " + line for line in f["message"].splitlines())
+    return "\n".join(out)
 
 
-def read_ci_logs() -> str:
+# Fixed head/tail windows per log file (bytes). Unset: derived from the per-log
+# token allotment, a quarter for the head (setup/config) and the rest for the
+# tail, where failures usually are.
+CI_LOG_HEAD_BYTES = int(os.environ.get("CI_LOG_HEAD_BYTES", "0"))
+CI_LOG_TAIL_BYTES = int(os.environ.get("CI_LOG_TAIL_BYTES", "0"))
+
+
+# Files the healer itself writes into ci-logs/; never read back as CI logs
+HEALER_OUTPUTS = {"deploy-investigation.json", "llm-metrics.json", "heal-cascade.json"}
+
+
+def read_head_tail(path: Path, head_bytes: int, tail_bytes: int) -> str:
+    """
+    Read at most head_bytes from the start and tail_bytes from the end of path,
+    seeking past the middle, so memory stays bounded regardless of file size.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= head_bytes + tail_bytes:
+            return f.read().decode("utf-8", errors="replace")
+        head = f.read(head_bytes)
+        f.seek(size - tail_bytes)
+        tail = f.read(tail_bytes)
+    # don't hand the model half lines at the seams
+    cut = head.rfind(b"\n")
+    if cut > 0:
+        head = head[:cut + 1]
+    cut = tail.find(b"\n")
+    if 0 <= cut < len(tail) - 1:
+        tail = tail[cut + 1:]
+    elided = size - len(head) - len(tail)
+    return (head.decode("utf-8", errors="replace")
+            + f"[... {elided} bytes elided ...]\n"
+            + tail.decode("utf-8", errors="replace"))
+
+
+def read_ci_logs(budget_tokens: int = 125_000) -> str:
+    """Concatenate ci-logs files, each capped at PROMPT_LOG_FILE_TOKENS, stopping at budget_tokens."""
     if not CILOG_DIR.exists():
         return ""
     blobs: List[str] = []
+    left = budget_tokens
+    stats: dict = {}
     for p in sorted(CILOG_DIR.rglob("*")):
-        if p.is_dir():
+        if p.is_dir() or p.name in HEALER_OUTPUTS or is_junit_report(p):
+            # the investigation JSON and JUnit reports have their own prompt sections; metrics are ours
             continue
+        header = f"=== {p.name} ===\n"
+        room = min(PROMPT_LOG_FILE_TOKENS, left - estimate_tokens(header) - 1)
+        if room <= 0:
+            break
+        # leave room for the elision marker so truncate_to_tokens never eats the tail
+        window = room * CHARS_PER_TOKEN - 64
+        head = CI_LOG_HEAD_BYTES or window // 4
+        tail = CI_LOG_TAIL_BYTES or window - head
         try:
-            text = p.read_text(encoding="utf-8", errors="replace")
+            text = read_condensed_log(p, head, tail, stats)
         except Exception:
             continue
-        if len(text) > 128_000:
-            text = text[:128_000] + "\n[...truncated...]\n"
-        blobs.append(f"=== {p.name} ===\n{text}\n")
-    return "\n".join(blobs)[:500_000]
+        blob = header + truncate_to_tokens(text, room) + "\n"
+        left -= estimate_tokens(blob) + 1
+        blobs.append(blob)
+    print_condense_stats("ci-logs", stats)
+    return "\n".join(blobs)
+
 
+# -------- source excerpting
+
+EXCERPT_SUFFIXES = {".js", ".jsx", ".ts", ".tsx", ".mjs", ".cjs", ".py"}
+JS_IMPORT_RE = re.compile(r"^(?:import\b|export\b.*\bfrom\b|(?:const|let|var)\b[^=]*=\s*require\(|['\"]use strict['\"])")
+
+
+def _py_units(text: str) -> List[Tuple[int, int, bool]] | None:
+    """Top-level (start, end, is_import) line ranges (1-based, inclusive) of a Python module."""
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return None
+    units = []
+    for node in tree.body:
+        start = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+        units.append((start, node.end_lineno or node.lineno, isinstance(node, (ast.Import, ast.ImportFrom))))
+    return units
+
+
+def _js_units(lines: List[str]) -> List[Tuple[int, int, bool]]:
+    """
+    Top-level statement ranges of JS/TS/JSX by bracket depth, skipping strings
+    and comments (regex literals are not special-cased; good enough for splitting).
+    A unit starts at a line that begins at depth 0 in column 0, unless it
+    continues a chain (`.then(...)`, `)`, `]`, `}`).
+    """
+    starts = []
+    depth = 0
+    in_block = False
+    quote = ""
+    for no, line in enumerate(lines, 1):
+        if depth == 0 and not in_block and not quote and line[:1] and not line[0].isspace() and line[0] not in ".)]}":
+            starts.append(no)
+        i = 0
+        n = len(line)
+        while i < n:
+            c = line[i]
+            if in_block:
+                if line.startswith("*/", i):
+                    in_block = False
+                    i += 1
+            elif quote:
+                if c == "\\":
+                    i += 1
+                elif c == quote:
+                    quote = ""
+            elif line.startswith("//", i):
+                break
+            elif line.startswith("/*", i):
+                in_block = True
+                i += 1
+            elif c in "'\"`":
+                quote = c
+            elif c in "([{":
+                depth += 1
+            elif c in ")]}":
+                depth = max(0, depth - 1)
+            i += 1
+        # only template literals may span lines
+        if quote and quote != "`":
+            quote = ""
+    units = []
+    for k, start in enumerate(starts):
+        end = starts[k + 1] - 1 if k + 1 < len(starts) else len(lines)
+        # trailing blank lines are gap, not body
+        while end > start and not lines[end - 1].strip():
+            end -= 1
+        units.append((start, end, bool(JS_IMPORT_RE.match(lines[start - 1]))))
+    return units
+
+
+def excerpt_source(rel: Path, text: str, keep_lines: set, max_chars: int) -> str | None:
+    """
+    Keep the top-level units (functions, classes, routes, ...) that contain an
+    anchored line, plus imports; collapse every other unit to a one-line stub.
+    Returns None when the file can't be split (caller falls back to truncation).
+    """
+    lines = text.splitlines()
+    if rel.suffix == ".py":
+        units = _py_units(text)
+        elided = "  # ... [{n} lines elided]"
+    else:
+        units = _js_units(lines)
+        elided = "  /* ... [{n} lines elided] */"
+    if not units:
+        return None
+    out: List[str] = []
+    shown = 0
+    prev_end = 0
+    for start, end, is_import in units:
+        # blank lines and comments between units are kept as-is
+        out.extend(lines[prev_end:start - 1])
+        body = lines[start - 1:end]
+        if is_import or len(body) <= 2 or any(start <= ln <= end for ln in keep_lines):
+            out.extend(body)
+            shown += 1
+        else:
+            # stub on the def/class line rather than a decorator
+            head = next((ln for ln in body if not ln.lstrip().startswith("@")), body[0])
+            out.append(head + elided.format(n=len(body) - 1))
+        prev_end = end
+    out.extend(lines[prev_end:])
+    note = f"[excerpt: {shown}/{len(units)} top-level units shown in full; anchored lines {sorted(keep_lines) or 'none'}]\n"
+    excerpt = note + "\n".join(out) + "\n"
+    return excerpt if len(excerpt) < len(text) else None
+
+
+def anchored_units(rel: Path, text: str, keep_lines: set) -> str:
+    """Just the top-level units containing an anchored line, each headed by its line range."""
+    lines = text.splitlines()
+    units = _py_units(text) if rel.suffix == ".py" else _js_units(lines)
+    out = []
+    for start, end, _ in units:
+        if any(start <= ln <= end for ln in keep_lines):
+            out.append(f"[lines {start}-{end}]\n" + "\n".join(lines[start - 1:end]))
+    return "\n".join(out)
+
+
+# Files above this size are never read (minified bundles, generated dumps)
+CONTEXT_MAX_FILE_BYTES = int(os.environ.get("CONTEXT_MAX_FILE_BYTES", str(4 * 1024 * 1024)))
+# Leading bytes inspected for NULs before a file is treated as text
+SNIFF_BYTES = 8192
+# Thread pool size for context file I/O (helps most on cold caches / network disks)
+CONTEXT_IO_WORKERS = int(os.environ.get("CONTEXT_IO_WORKERS", str(min(16, (os.cpu_count() or 2) * 4))))
+
+
+def load_text(path: Path, limit_bytes: int) -> str | None:
+    """Read up to limit_bytes of path as text; None for binary files (NUL in the first SNIFF_BYTES)."""
+    with open(path, "rb") as f:
+        head = f.read(min(SNIFF_BYTES, limit_bytes))
+        if b"\0" in head:
+            return None
+        rest = f.read(limit_bytes - len(head)) if len(head) < limit_bytes else b""
+        more = f.read(1)
+    text = (head + rest).decode("utf-8", errors="replace")
+    return text + TRUNCATED if more else text
+
+
+def read_code_context(budget_tokens: int = 200_000, shown: set | None = None) -> str:
+    """
+    Render the snapshot in discovery order, greedily filling budget_tokens: a
+    file that doesn't fit is skipped, smaller ones may still fit. Nothing here
+    depends on the failure, so the same tree renders the same snapshot.
+    Sizes are taken from stat() to pick files before anything is read; the
+    picked files are then loaded on a bounded thread pool, in order.
+    Oversized JS/TS/Python sources are excerpted (imports plus stubs) rather
+    than cut at the front; read_focus_context() adds the anchored units.
+    The posix paths rendered are added to `shown`, if given.
+    """
+    cache = context_cache()
+    blob_ids = git_blob_ids() if cache else {}
+    files = important_files()
+    limit_bytes = PROMPT_CODE_FILE_TOKENS * CHARS_PER_TOKEN
+
+    def probe(rel: Path) -> Tuple[str | None, str | None, int]:
+        """(cache key, cached blob, estimated cost in tokens; -1 = skip)."""
+        key = blob_cache_key(rel, blob_ids, PROMPT_CODE_FILE_TOKENS) if cache else None
+        cached = cache.get(key) if key else None
+        if cached is not None:
+            blob = cached.decode("utf-8")
+            return key, blob, estimate_tokens(blob) + 1
+        try:
+            size = (ROOT / rel).stat().st_size
+        except OSError:
+            return key, None, -1
+        if size > CONTEXT_MAX_FILE_BYTES:
+            return key, None, -1
+        header = f"=== {rel.as_posix()} ===\n"
+        # body (+ marker if it will be cut), trailing newline and the joining newline
+        body = min(size, limit_bytes) + (len(TRUNCATED) if size > limit_bytes else 0)
+        return key, None, estimate_tokens(header) + (body + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN + 2
+
+    def load(item: Tuple[Path, str | None]) -> str | None:
+        rel, key = item
+        excerptable = rel.suffix in EXCERPT_SUFFIXES
+        try:
+            # excerptable sources are read whole so the tail of a big module can survive
+            text = load_text(ROOT / rel, CONTEXT_MAX_FILE_BYTES if excerptable else limit_bytes)
+        except OSError:
+            return None
+        if text is None:
+            return None
+        if excerptable and len(text) > limit_bytes:
+            text = excerpt_source(rel, text, set(), limit_bytes) or text
+        blob = f"=== {rel.as_posix()} ===\n{truncate_to_tokens(text, PROMPT_CODE_FILE_TOKENS)}\n"
+        if key:
+            cache.put(key, blob.encode("utf-8"))
+        return blob
+
+    with ThreadPoolExecutor(max_workers=max(1, CONTEXT_IO_WORKERS)) as pool:
+        probes = list(pool.map(probe, files))
+        # pick by estimate (an upper bound: decoded chars <= bytes read)
+        picked = []
+        total = 0
+        for rel, (key, blob, cost) in zip(files, probes):
+            if cost < 0 or total + cost > budget_tokens:
+                continue
+            total += cost
+            picked.append((rel, key, blob))
+        misses = [(rel, key) for rel, key, blob in picked if blob is None]
+        loaded = dict(zip((rel for rel, _ in misses), pool.map(load, misses)))
 
-def read_code_context() -> str:
     chunks: List[str] = []
-    total = 0
-    for rel in important_files():
+    for rel, _, blob in picked:
+        blob = blob if blob is not None else loaded.get(rel)
+        if blob:
+            chunks.append(blob)
+            if shown is not None:
+                shown.add(rel.as_posix())
+    if cache:
+        cache.evict()
+        print(f"context cache: {cache.hits} hits, {cache.misses} misses")
+    return "\n".join(chunks)
+
+
+def read_focus_context(anchors: dict, budget_tokens: int, shown: set) -> str:
+    """
+    The failure-specific view of the snapshot, for the volatile suffix: files
+    cited by the failures, most relevant first, then, in that order while they
+    fit, the content the snapshot lacks. A cited file the snapshot (`shown`)
+    left out is rendered like a snapshot file, excerpted around its anchors
+    when oversized (just the anchored units if even that doesn't fit); one the
+    snapshot could only show stubbed gets its anchored units.
+    """
+    ranked = [rel for rel in rank_files(important_files(), anchors) if score_file(rel, anchors) > 0]
+    ranked = ranked[:PROMPT_FOCUS_FILES]
+    if not ranked:
+        return ""
+    hints = []
+    for rel in ranked:
+        lines = sorted(anchor_lines(rel, anchors))
+        hints.append(rel.as_posix() + (f" (lines {', '.join(map(str, lines))})" if lines else ""))
+    chunks = ["RANKING: " + "; ".join(hints) + "\n"]
+    total = estimate_tokens(chunks[0])
+    limit_bytes = PROMPT_CODE_FILE_TOKENS * CHARS_PER_TOKEN
+    for rel in ranked:
+        lines = anchor_lines(rel, anchors)
+        excerptable = rel.suffix in EXCERPT_SUFFIXES
+        in_snapshot = rel.as_posix() in shown
         try:
-            text = (ROOT / rel).read_text(encoding="utf-8", errors="replace")
-        except Exception:
+            size = (ROOT / rel).stat().st_size
+            # the snapshot already holds it in full (or it can't be excerpted any better)
+            if size > CONTEXT_MAX_FILE_BYTES or in_snapshot and not (excerptable and lines and size > limit_bytes):
+                continue
+            text = load_text(ROOT / rel, CONTEXT_MAX_FILE_BYTES if excerptable else limit_bytes)
+        except OSError:
             continue
-        if len(text) > 120_000:
-            text = text[:120_000] + "\n[...truncated...]\n"
-        blob = f"=== {rel.as_posix()} ===\n{text}\n"
-        total += len(blob)
-        if total > 800_000:
-            break
-        chunks.append(blob)
+        if text is None:
+            continue
+        bodies = [anchored_units(rel, text, lines)] if in_snapshot else [
+            excerpt_source(rel, text, lines, limit_bytes) or text if excerptable and len(text) > limit_bytes else text,
+            anchored_units(rel, text, lines) if excerptable and lines else "",
+        ]
+        for body in filter(None, bodies):
+            blob = f"=== {rel.as_posix()} ===\n{truncate_to_tokens(body, PROMPT_CODE_FILE_TOKENS)}\n"
+            cost = estimate_tokens(blob) + 1
+            if total + cost <= budget_tokens:
+                total += cost
+                chunks.append(blob)
+                break
     return "\n".join(chunks)
 
 
 # -------- Vertex AI
 
-def vertex_generate_patch(prompt: str) -> str:
-    """Call Vertex AI GenerativeModel to obtain a unified diff patch inside ```diff ...```."""
-    try:
-        from vertexai import init as vertex_init
-        from vertexai.generative_models import GenerativeModel
-    except Exception as e:
-        print(f"Vertex SDK import failed: {e}")
-        raise
+_VERTEX_LOCK = threading.Lock()
+_TIMINGS_LOCK = threading.Lock()
+_VERTEX_INITIALIZED: set = set()   # (project, location) pairs passed to vertexai.init
+_VERTEX_MODELS: dict = {}          # (project, location, model) -> GenerativeModel
+# One record per SDK init / generate call: {"op", "model", "seconds"}
+VERTEX_TIMINGS: List[dict] = []
 
+
+def vertex_settings() -> Tuple[str, str, str]:
     project = os.environ.get("GCP_PROJECT_ID")
     location = os.environ.get("GCP_LOCATION")
     model_name = os.environ.get("VERTEX_MODEL", "gemini-1.5-pro")
-
     if not project or not location:
         print("Missing GCP_PROJECT_ID or GCP_LOCATION")
         raise SystemExit(6)
+    return project, location, model_name
+
+
+def _record_timing(op: str, model_name: str, started: float) -> float:
+    elapsed = time.monotonic() - started
+    with _TIMINGS_LOCK:
+        VERTEX_TIMINGS.append({"op": op, "model": model_name, "seconds": round(elapsed, 3)})
+    print(f"vertex {op} ({model_name}): {elapsed:.2f}s")
+    return elapsed
+
+
+def vertex_model(model_name: str | None = None):
+    """
+    Process-wide GenerativeModel for (project, location, model): the SDK import,
+    vertexai.init() and model construction happen once, under a lock.
+    """
+    project, location, default_model = vertex_settings()
+    model_name = model_name or default_model
+    key = (project, location, model_name)
+    with _VERTEX_LOCK:
+        model = _VERTEX_MODELS.get(key)
+        if model is None:
+            started = time.monotonic()
+            from vertexai import init as vertex_init
+            from vertexai.generative_models import GenerativeModel
+            if (project, location) not in _VERTEX_INITIALIZED:
+                vertex_init(project=project, location=location)
+                _VERTEX_INITIALIZED.add((project, location))
+            model = GenerativeModel(model_name)
+            _VERTEX_MODELS[key] = model
+            _record_timing("init", model_name, started)
+    return model
+
+
+def response_text(resp) -> str:
+    text = getattr(resp, "text", None) or (
+        resp.candidates[0].content.parts[0].text
+        if getattr(resp, "candidates", None) else ""
+    )
+    return text or ""
+
+
+# -------- LLM backends
+
+# vertex | replay | synthetic -- the offline backends need no GCP credentials
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "vertex").lower()
+# replay: JSONL of {"key", "model", "text"} records (see LLM_RECORD_PATH)
+LLM_REPLAY_PATH = os.environ.get("LLM_REPLAY_PATH", "")
+# any backend: append every response as a replay record
+LLM_RECORD_PATH = os.environ.get("LLM_RECORD_PATH", "")
+# synthetic: median latency, log-normal spread, failure rate, response text file, RNG seed
+LLM_SYNTHETIC_LATENCY_MS = float(os.environ.get("LLM_SYNTHETIC_LATENCY_MS", "2000"))
+LLM_SYNTHETIC_JITTER = float(os.environ.get("LLM_SYNTHETIC_JITTER", "0.5"))
+LLM_SYNTHETIC_FAILURE_RATE = float(os.environ.get("LLM_SYNTHETIC_FAILURE_RATE", "0"))
+LLM_SYNTHETIC_RESPONSE = os.environ.get("LLM_SYNTHETIC_RESPONSE", "")
+LLM_SYNTHETIC_SEED = int(os.environ.get("LLM_SYNTHETIC_SEED", "0"))
+# synthetic: time to produce each streamed chunk (0: the whole reply is ready after the latency)
+LLM_SYNTHETIC_CHUNK_MS = float(os.environ.get("LLM_SYNTHETIC_CHUNK_MS", "0"))
+# characters per chunk when an offline backend streams
+LLM_STREAM_CHUNK_CHARS = 64
+
+
+def default_model_name() -> str:
+    return os.environ.get("VERTEX_MODEL", "gemini-1.5-pro")
+
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class _TextResponse:
+    """Minimal stand-in for a GenerationResponse (and for a streamed chunk)."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _CannedModel:
+    """
+    generate_content() over respond(prompt) -> text, streaming in fixed-size
+    chunks, each taking chunk_s to "generate" (an unstreamed call waits for all).
+    """
+
+    def __init__(self, name: str, respond, chunk_s: float = 0.0):
+        self.name = name
+        self._respond = respond
+        self._chunk_s = chunk_s
+
+    def generate_content(self, contents: str, stream: bool = False, **kwargs):
+        text = self._respond(contents)
+        chunks = [text[i:i + LLM_STREAM_CHUNK_CHARS] for i in range(0, len(text), LLM_STREAM_CHUNK_CHARS)]
+        if not stream:
+            time.sleep(self._chunk_s * len(chunks))
+            return _TextResponse(text)
+        return self._stream(chunks)
+
+    def _stream(self, chunks: List[str]) -> Iterator[_TextResponse]:
+        for chunk in chunks:
+            time.sleep(self._chunk_s)
+            yield _TextResponse(chunk)
+
+
+class LLMBackend(ABC):
+    """Source of model objects exposing generate_content(prompt, stream=False, **kwargs)."""
+
+    name = "base"
+
+    @abstractmethod
+    def model(self, model_name: str):
+        ...
+
+
+class VertexBackend(LLMBackend):
+    name = "vertex"
+
+    def model(self, model_name: str):
+        return vertex_model(model_name)
+
+
+class ReplayBackend(LLMBackend):
+    """
+    Serves responses recorded with LLM_RECORD_PATH: exact prompt match first,
+    otherwise the recordings in order (cycling), so replays survive small
+    prompt drift.
+    """
+
+    name = "replay"
+
+    def __init__(self, path: str):
+        self.records: List[dict] = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.records.append(json.loads(line))
+        if not self.records:
+            raise ValueError(f"no replay records in {path}")
+        self._by_key = {r.get("key"): r for r in self.records}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _respond(self, prompt: str) -> str:
+        rec = self._by_key.get(prompt_key(prompt))
+        if rec is None:
+            with self._lock:
+                rec = self.records[self._next % len(self.records)]
+                self._next += 1
+        return rec.get("text", "")
+
+    def model(self, model_name: str):
+        return _CannedModel(model_name, self._respond)
+
+
+class SyntheticLLMError(RuntimeError):
+    pass
+
+
+class SyntheticBackend(LLMBackend):
+    """Canned response after a seeded log-normal delay, failing at LLM_SYNTHETIC_FAILURE_RATE."""
+
+    name = "synthetic"
+
+    def __init__(self, text: str, latency_ms: float, jitter: float, failure_rate: float, seed: int,
+                 chunk_ms: float = 0.0):
+        self.text = text
+        self.latency_ms = latency_ms
+        self.chunk_ms = chunk_ms
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _respond(self, prompt: str) -> str:
+        with self._lock:
+            delay = self.latency_ms * self._rng.lognormvariate(0, self.jitter) if self.jitter else self.latency_ms
+            fail = self._rng.random() < self.failure_rate
+        time.sleep(delay / 1000)
+        if fail:
+            raise SyntheticLLMError("synthetic backend: injected failure")
+        return self.text
+
+    def model(self, model_name: str):
+        return _CannedModel(model_name, self._respond, self.chunk_ms / 1000)
+
+
+_BACKEND: LLMBackend | None = None
+_BACKEND_LOCK = threading.Lock()
+
+
+def get_backend() -> LLMBackend:
+    """Process-wide backend, built once under a lock (candidates and hedges call this from worker threads)."""
+    global _BACKEND
+    with _BACKEND_LOCK:
+        if _BACKEND is None:
+            if LLM_BACKEND == "replay":
+                _BACKEND = ReplayBackend(LLM_REPLAY_PATH)
+            elif LLM_BACKEND == "synthetic":
+                text = Path(LLM_SYNTHETIC_RESPONSE).read_text(encoding="utf-8") if LLM_SYNTHETIC_RESPONSE else "```diff\n```\n"
+                _BACKEND = SyntheticBackend(text, LLM_SYNTHETIC_LATENCY_MS, LLM_SYNTHETIC_JITTER,
+                                            LLM_SYNTHETIC_FAILURE_RATE, LLM_SYNTHETIC_SEED, LLM_SYNTHETIC_CHUNK_MS)
+            else:
+                _BACKEND = VertexBackend()
+        return _BACKEND
+
+
+def llm_model(model_name: str | None = None):
+    return get_backend().model(model_name or default_model_name())
+
+
+_RECORD_LOCK = threading.Lock()
+
+
+def record_response(prompt: str, model_name: str, text: str) -> None:
+    if not LLM_RECORD_PATH:
+        return
+    rec = {"key": prompt_key(prompt), "model": model_name, "text": text}
+    with _RECORD_LOCK, open(LLM_RECORD_PATH, "a", encoding="utf-8") as f:
+        f.write(json.dumps(rec) + "\n")
+
+
+# Stream responses and stop reading once the diff is complete
+VERTEX_STREAM = os.environ.get("VERTEX_STREAM", "0") == "1"
+# Give up on a streamed answer that has produced this many tokens without starting a diff
+VERTEX_STREAM_NO_FENCE_TOKENS = int(os.environ.get("VERTEX_STREAM_NO_FENCE_TOKENS", "4000"))
+# Prose tolerated after a finished diff block before cancelling (replies may split a fix across blocks)
+VERTEX_STREAM_TAIL_TOKENS = int(os.environ.get("VERTEX_STREAM_TAIL_TOKENS", "200"))
+
+
+class DiffStreamScanner:
+    """
+    Streamed-reply side of scan_diff_blocks(): complete lines go through the
+    same DiffScanner, so ```patch fences, bare diffs and indented fences are
+    judged alike. feed() turns True once a diff block has finished and
+    VERTEX_STREAM_TAIL_TOKENS more arrived without another one starting.
+    Chunks are kept as a list and only joined by `text`, so feeding costs
+    time linear in the reply.
+    """
+
+    def __init__(self):
+        self.scanner = DiffScanner()
+        self.length = 0      # chars fed so far
+        self._chunks: List[str] = []
+        self._line: List[str] = []  # pieces of the line still being received
+        self._scan = 0       # start of the first line not pushed yet
+        self._done_at = -1   # where the text after the last finished block starts
+
+    @property
+    def text(self) -> str:
+        return "".join(self._chunks)
+
+    @property
+    def tokens(self) -> int:
+        """estimate_tokens(self.text), without joining it."""
+        return (self.length + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    @property
+    def opened(self) -> bool:
+        return self.scanner.in_diff or bool(self.scanner.blocks)
+
+    def feed(self, chunk: str) -> bool:
+        self._chunks.append(chunk)
+        self.length += len(chunk)
+        lines = chunk.split("\n")
+        if len(lines) > 1:
+            lines[0] = "".join(self._line) + lines[0]
+            self._line = []
+            for line in lines[:-1]:
+                self.scanner.push(line)
+                self._scan += len(line) + 1
+                if self.scanner.in_diff:
+                    self._done_at = -1
+                elif self.scanner.blocks and self._done_at < 0:
+                    self._done_at = self._scan
+        if lines[-1]:
+            self._line.append(lines[-1])
+        tail = self.length - self._done_at
+        return self._done_at >= 0 and (tail + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN > VERTEX_STREAM_TAIL_TOKENS
+
+
+def _chunk_text(chunk) -> str:
+    try:
+        return response_text(chunk)
+    except Exception:
+        # chunks carrying only safety/usage metadata have no text part
+        return ""
+
+
+def vertex_generate_stream(prompt: str, model_name: str | None = None, model=None,
+                           rec: dict | None = None, **kwargs) -> str:
+    """
+    generate_content(stream=True), cancelled once the diff is complete (see
+    DiffStreamScanner), or once VERTEX_STREAM_NO_FENCE_TOKENS pass without one.
+    Returns the text received so far. Time to first chunk and usage go into rec.
+    """
+    rec = rec if rec is not None else {}
+    model_name = model_name or default_model_name()
+    model = model or llm_model(model_name)
+    scanner = DiffStreamScanner()
+    started = time.monotonic()
+    stream = model.generate_content(prompt, stream=True, **kwargs)
+    first_chunk = True
+    try:
+        for chunk in stream:
+            if first_chunk:
+                rec["ttft_s"] = round(_record_timing("first-chunk", model_name, started), 3)
+                first_chunk = False
+            rec.update(usage_counts(chunk))
+            if scanner.feed(_chunk_text(chunk)):
+                print("diff complete; cancelling stream")
+                break
+            if not scanner.opened and scanner.tokens > VERTEX_STREAM_NO_FENCE_TOKENS:
+                print(f"no diff after ~{VERTEX_STREAM_NO_FENCE_TOKENS} tokens; aborting stream")
+                break
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+    _record_timing("generate", model_name, started)
+    record_response(prompt, model_name, scanner.text)
+    return scanner.text
+
+
+# -------- telemetry
+
+# One record per logical model call, rewritten after every call (next to deploy-investigation.json)
+LLM_METRICS_FILE = os.environ.get("LLM_METRICS_FILE", str(CILOG_DIR / "llm-metrics.json"))
+# Optional USD prices per million tokens, for a cost estimate in each record
+LLM_PRICE_INPUT_PER_MTOK = float(os.environ.get("LLM_PRICE_INPUT_PER_MTOK", "0"))
+LLM_PRICE_OUTPUT_PER_MTOK = float(os.environ.get("LLM_PRICE_OUTPUT_PER_MTOK", "0"))
+USAGE_FIELDS = ("prompt_token_count", "candidates_token_count", "total_token_count", "cached_content_token_count")
+
+LLM_METRICS: List[dict] = []
+_METRICS_LOCK = threading.Lock()
+# Estimated tokens per prompt section of the current heal; set by main() once the prompt is built
+PROMPT_SECTIONS: dict = {}
+
+
+def usage_counts(resp) -> dict:
+    """usage_metadata token counts from a response or stream chunk (empty when absent)."""
+    um = getattr(resp, "usage_metadata", None)
+    if um is None:
+        return {}
+    out = {}
+    for k in USAGE_FIELDS:
+        v = getattr(um, k, None)
+        if v:
+            out[k] = int(v)
+    return out
+
+
+def new_call_record(prompt: str, model_name: str) -> dict:
+    return {
+        "ts": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "backend": LLM_BACKEND,
+        "model": model_name,
+        "prompt_chars": len(prompt),
+        "prompt_tokens_est": estimate_tokens(prompt),
+        "sections_tokens_est": dict(PROMPT_SECTIONS),
+        "attempts": 0,
+    }
+
+
+def finish_call_record(rec: dict, started: float, outcome: str, text: str = "") -> None:
+    rec["latency_s"] = round(time.monotonic() - started, 3)
+    rec.setdefault("ttft_s", rec["latency_s"])
+    rec["outcome"] = outcome
+    rec["response_chars"] = len(text)
+    if LLM_PRICE_INPUT_PER_MTOK or LLM_PRICE_OUTPUT_PER_MTOK:
+        tokens_in = rec.get("prompt_token_count", rec["prompt_tokens_est"])
+        tokens_out = rec.get("candidates_token_count", estimate_tokens(text))
+        rec["cost_usd"] = round((tokens_in * LLM_PRICE_INPUT_PER_MTOK + tokens_out * LLM_PRICE_OUTPUT_PER_MTOK) / 1e6, 6)
+    with _METRICS_LOCK:
+        LLM_METRICS.append(rec)
+        if LLM_METRICS_FILE:
+            try:
+                path = Path(LLM_METRICS_FILE)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(json.dumps(LLM_METRICS, indent=2), encoding="utf-8")
+            except OSError as e:
+                print(f"could not write {LLM_METRICS_FILE}: {e}")
+
+
+# -------- call policy (deadline, retries, hedging)
+
+# Overall wall-clock budget for one logical model call, retries and hedges included
+LLM_DEADLINE_S = float(os.environ.get("LLM_DEADLINE_S", "600"))
+LLM_MAX_ATTEMPTS = int(os.environ.get("LLM_MAX_ATTEMPTS", "4"))
+# Full-jitter exponential backoff: sleep U(0, min(cap, base * 2**n))
+LLM_BACKOFF_BASE_S = float(os.environ.get("LLM_BACKOFF_BASE_S", "1.0"))
+LLM_BACKOFF_CAP_S = float(os.environ.get("LLM_BACKOFF_CAP_S", "30"))
+# Hedging: once a call outlives the p95 of past latencies, fire a second one and take whichever answers first
+LLM_HEDGE = os.environ.get("LLM_HEDGE", "0") == "1"
+# Used until LLM_HEDGE_MIN_SAMPLES latencies have been seen
+LLM_HEDGE_AFTER_S = float(os.environ.get("LLM_HEDGE_AFTER_S", "60"))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get("LLM_HEDGE_MIN_SAMPLES", "5"))
+# Latencies persist across runs so p95 is meaningful for a process that makes one call
+LLM_LATENCY_FILE = os.environ.get("LLM_LATENCY_FILE", str(Path.home() / ".cache" / "agentic-heal" / "latency.json"))
+LLM_LATENCY_KEEP = 200
+
+# Matched by class name so google.api_core stays an optional import
+RETRYABLE_ERRORS = {
+    "ServiceUnavailable", "TooManyRequests", "ResourceExhausted", "DeadlineExceeded",
+    "InternalServerError", "BadGateway", "GatewayTimeout", "Aborted", "RetryError",
+    "ConnectionError", "TimeoutError", "SyntheticLLMError",
+}
+
+
+def is_retryable(exc: BaseException) -> bool:
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(exc).__mro__)
+
+
+CONTEXT_LENGTH_RE = re.compile(
+    r"input token count|maximum number of tokens|context (?:length|window)|too many (?:input )?tokens|prompt is too long",
+    re.I,
+)
+# e.g. "The input token count (1234567) exceeds the maximum number of tokens allowed (1048576)."
+TOKEN_LIMIT_RE = re.compile(r"token count \(?(\d+)\)?.*?tokens allowed \(?(\d+)\)?", re.I | re.S)
+
+
+class PromptTooLong(Exception):
+    """The model rejected (or would reject) a prompt for exceeding its input limit."""
+
+    def __init__(self, message: str, ratio: float = 0.0):
+        super().__init__(message)
+        self.ratio = ratio  # accepted/sent tokens when known, else 0
+
+
+def as_prompt_too_long(exc: BaseException) -> PromptTooLong | None:
+    """PromptTooLong for a model error that is about input length, else None."""
+    msg = str(exc)
+    if not CONTEXT_LENGTH_RE.search(msg):
+        return None
+    m = TOKEN_LIMIT_RE.search(msg)
+    return PromptTooLong(msg, int(m.group(2)) / int(m.group(1)) if m and int(m.group(1)) else 0.0)
+
+
+def _load_latencies() -> dict:
+    try:
+        return json.loads(Path(LLM_LATENCY_FILE).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
 
-    vertex_init(project=project, location=location)
-    model = GenerativeModel(model_name)
+
+def _latency_key(model_name: str) -> str:
+    """History is per backend too: replay/synthetic latencies must not set the hedge point for Vertex."""
+    return f"{LLM_BACKEND}:{model_name}"
+
+
+def remember_latency(model_name: str, seconds: float) -> None:
+    if not LLM_LATENCY_FILE:
+        return
+    key = _latency_key(model_name)
+    with _TIMINGS_LOCK:
+        hist = _load_latencies()
+        hist[key] = (hist.get(key, []) + [round(seconds, 3)])[-LLM_LATENCY_KEEP:]
+        path = Path(LLM_LATENCY_FILE)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(hist, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"could not save latency history: {e}")
+
+
+def hedge_delay(model_name: str) -> float:
+    """
+    p95 of known generate latencies for model_name, or LLM_HEDGE_AFTER_S without
+    enough samples. The latency file already holds this process's calls
+    (remember_latency), so it is the only source when set; VERTEX_TIMINGS
+    stands in when it is off.
+    """
+    if LLM_LATENCY_FILE:
+        samples = _load_latencies().get(_latency_key(model_name), [])
+    else:
+        samples = [t["seconds"] for t in VERTEX_TIMINGS if t["op"] == "generate" and t["model"] == model_name]
+    samples = sorted(samples)
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return LLM_HEDGE_AFTER_S
+    return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+
+def _spawn(fn) -> Future:
+    """Run fn on a daemon thread: an abandoned (timed-out or out-raced) call never blocks exit."""
+    fut: Future = Future()
+
+    def runner():
+        if not fut.set_running_or_notify_cancel():
+            return
+        try:
+            fut.set_result(fn())
+        except BaseException as e:
+            fut.set_exception(e)
+
+    threading.Thread(target=runner, daemon=True).start()
+    return fut
+
+
+def _hedged(fn, timeout: float, model_name: str):
+    primary = _spawn(fn)
+    if not LLM_HEDGE:
+        return primary.result(timeout=timeout)
+    end = time.monotonic() + timeout
+    after = hedge_delay(model_name)
+    done, _ = wait([primary], timeout=min(after, timeout))
+    if done:
+        return primary.result()
+    print(f"model call slower than p95 ({after:.1f}s); sending hedge request")
+    pending = {primary, _spawn(fn)}
+    error: BaseException | None = None
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError(f"model call exceeded {timeout:.0f}s")
+        for f in done:
+            if f.exception() is None:
+                return f.result()
+            error = f.exception()
+    raise error
+
+
+def call_with_policy(fn, model_name: str, rec: dict | None = None):
+    """
+    Run fn() under LLM_DEADLINE_S, retrying retryable errors with full-jitter
+    exponential backoff and (LLM_HEDGE=1) hedging slow attempts.
+    """
+    deadline = time.monotonic() + LLM_DEADLINE_S
+    attempt = 0
+    while True:
+        attempt += 1
+        if rec is not None:
+            rec["attempts"] = attempt
+        started = time.monotonic()
+        try:
+            result = _hedged(fn, deadline - started, model_name)
+            remember_latency(model_name, time.monotonic() - started)
+            return result
+        except Exception as e:
+            if not is_retryable(e) or attempt >= LLM_MAX_ATTEMPTS:
+                raise
+            pause = random.uniform(0, min(LLM_BACKOFF_CAP_S, LLM_BACKOFF_BASE_S * 2 ** (attempt - 1)))
+            if time.monotonic() + pause >= deadline:
+                raise
+            print(f"model call failed ({type(e).__name__}: {e}); retry {attempt}/{LLM_MAX_ATTEMPTS - 1} in {pause:.1f}s")
+            time.sleep(pause)
+
+
+def _generate_once(prompt: str, model_name: str, model, rec: dict, **kwargs) -> str:
+    if VERTEX_STREAM:
+        return vertex_generate_stream(prompt, model_name, model=model, rec=rec, **kwargs)
+    model = model or llm_model(model_name)
+    started = time.monotonic()
+    resp = model.generate_content(prompt, **kwargs)
+    _record_timing("generate", model_name, started)
+    rec.update(usage_counts(resp))
+    text = response_text(resp)
+    record_response(prompt, model_name, text)
+    return text
+
+
+def vertex_generate(prompt: str, model_name: str | None = None, model=None, **kwargs) -> str:
+    """
+    generate_content() on the given model or the LLM_BACKEND one, timed
+    (streamed when VERTEX_STREAM=1), under the deadline/retry/hedge policy.
+    Each call leaves a record in LLM_METRICS / LLM_METRICS_FILE.
+    """
+    model_name = model_name or default_model_name()
+    rec = new_call_record(prompt, model_name)
+    started = time.monotonic()
+    try:
+        text = call_with_policy(lambda: _generate_once(prompt, model_name, model, rec, **kwargs), model_name, rec)
+    except BaseException as e:
+        finish_call_record(rec, started, f"error: {type(e).__name__}: {e}")
+        raise
+    finish_call_record(rec, started, "ok", text)
+    return text
+
+
+def vertex_generate_patch(prompt: str) -> str:
+    """Call Vertex AI GenerativeModel to obtain a unified diff patch inside ```diff ...```."""
+    if get_backend().name == "vertex":
+        try:
+            import vertexai  # noqa: F401
+        except Exception as e:
+            print(f"Vertex SDK import failed: {e}")
+            raise
 
     sys_prompt = textwrap.dedent("""
     You are an expert DevOps+Software agent. You are given CI logs and code snapshots.
@@ -200,104 +1746,880 @@ def vertex_generate_patch(prompt: str) -> str:
 
     full_prompt = sys_prompt + "\n\n" + prompt
     try:
-        resp = model.generate_content(full_prompt)
-        text = getattr(resp, "text", None) or (
-            resp.candidates[0].content.parts[0].text
-            if getattr(resp, "candidates", None) else ""
-        )
-        return text or ""
+        return vertex_generate(full_prompt)
     except Exception as e:
         print(f"Vertex call failed: {e}")
         raise SystemExit(5)
 
 
+# -------- context caching
+
+# Server-side caching of the stable prompt prefix: off | vertex | memory (in-process stand-in for tests)
+VERTEX_CONTEXT_CACHE = os.environ.get("VERTEX_CONTEXT_CACHE", "off").lower()
+VERTEX_CONTEXT_CACHE_TTL = int(os.environ.get("VERTEX_CONTEXT_CACHE_TTL", "3600"))
+# Vertex refuses to cache contents smaller than this
+VERTEX_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get("VERTEX_CONTEXT_CACHE_MIN_TOKENS", "32768"))
+
+
+def prefix_key(model_name: str, prefix: str) -> str:
+    return hashlib.sha256(f"{model_name}\0{prefix}".encode("utf-8")).hexdigest()
+
+
+class ContextCache(ABC):
+    """
+    Caches a stable prompt prefix (system rules + repo snapshot) so repeated
+    calls only send the volatile suffix. model_for() returns a model whose
+    generate_content() takes just the suffix, or None when the prefix can't
+    be cached (caller then sends prefix + suffix).
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def model_for(self, model_name: str, prefix: str):
+        ...
+
+
+class _PrefixedModel:
+    """Model wrapper that prepends a locally held prefix; what InMemoryContextCache hands out."""
+
+    def __init__(self, model, prefix: str):
+        self._model = model
+        self._prefix = prefix
+
+    def generate_content(self, contents: str, **kwargs):
+        return self._model.generate_content(self._prefix + "\n\n" + contents, **kwargs)
+
+
+class InMemoryContextCache(ContextCache):
+    """Process-local stand-in: records hits/misses per prefix, sends the full prompt to `model_factory(model_name)`."""
+
+    def __init__(self, model_factory=None):
+        super().__init__()
+        self._model_factory = model_factory or llm_model
+        self._prefixes: dict = {}
+
+    def model_for(self, model_name: str, prefix: str):
+        key = prefix_key(model_name, prefix)
+        with self._lock:
+            if key in self._prefixes:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._prefixes[key] = prefix
+        return _PrefixedModel(self._model_factory(model_name), prefix)
+
+
+class VertexContextCache(ContextCache):
+    """
+    Vertex AI CachedContent. Entries are named after the prefix hash, so a
+    later process (re-run on the same tree) finds and reuses them too.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._handles: dict = {}
+
+    def model_for(self, model_name: str, prefix: str):
+        if estimate_tokens(prefix) < VERTEX_CONTEXT_CACHE_MIN_TOKENS:
+            return None
+        vertex_model(model_name)  # makes sure vertexai.init() ran
+        from vertexai.preview import caching
+        from vertexai.preview.generative_models import GenerativeModel
+
+        key = prefix_key(model_name, prefix)
+        display_name = f"agentic-heal-{key[:40]}"
+        with self._lock:
+            cached = self._handles.get(key)
+            if cached is None:
+                cached = next((c for c in caching.CachedContent.list() if c.display_name == display_name), None)
+            if cached is not None:
+                self.hits += 1
+            else:
+                started = time.monotonic()
+                cached = caching.CachedContent.create(
+                    model_name=model_name,
+                    contents=[prefix],
+                    ttl=timedelta(seconds=VERTEX_CONTEXT_CACHE_TTL),
+                    display_name=display_name,
+                )
+                _record_timing("cache-create", model_name, started)
+                self.misses += 1
+            self._handles[key] = cached
+        return GenerativeModel.from_cached_content(cached_content=cached)
+
+
+_CONTEXT_CACHE: ContextCache | None = None
+_CONTEXT_CACHE_LOCK = threading.Lock()
+
+
+def get_context_cache() -> ContextCache | None:
+    global _CONTEXT_CACHE
+    with _CONTEXT_CACHE_LOCK:
+        if _CONTEXT_CACHE is None:
+            if VERTEX_CONTEXT_CACHE == "vertex" and get_backend().name == "vertex":
+                _CONTEXT_CACHE = VertexContextCache()
+            elif VERTEX_CONTEXT_CACHE == "memory":
+                _CONTEXT_CACHE = InMemoryContextCache()
+        return _CONTEXT_CACHE
+
+
+def generate_with_prefix(prefix: str, suffix: str, model_name: str | None = None, **kwargs) -> str:
+    """Generate for prefix + suffix, sending only the suffix when the context cache holds the prefix."""
+    cache = get_context_cache()
+    model = None
+    if cache:
+        try:
+            model = cache.model_for(model_name or default_model_name(), prefix)
+        except Exception as e:
+            print(f"context cache unavailable, sending full prompt: {e}")
+    if model is not None:
+        return vertex_generate(suffix, model_name, model=model, **kwargs)
+    return vertex_generate(prefix + "\n\n" + suffix, model_name, **kwargs)
+
+
+# -------- LLM response cache
+
+# Responses keyed by sha256(model, system prompt, user prompt); LLM_CACHE_DIR=off disables
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", str(Path.home() / ".cache" / "agentic-heal" / "llm"))
+LLM_CACHE_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+# Only serve responses whose patch later passed run_tests() (re-serving a bad patch helps nobody)
+LLM_CACHE_ONLY_VALIDATED = os.environ.get("LLM_CACHE_ONLY_VALIDATED", "1") == "1"
+
+
+def llm_cache() -> DiskCache | None:
+    if not LLM_CACHE_DIR or LLM_CACHE_DIR.lower() in ("0", "off", "none"):
+        return None
+    return DiskCache(Path(LLM_CACHE_DIR), LLM_CACHE_MAX_BYTES)
+
+
+def llm_cache_key(model_name: str, system: str, prompt: str) -> str:
+    h = hashlib.sha256()
+    for part in (model_name, system, prompt):
+        data = part.encode("utf-8")
+        # length-prefixed so ("ab", "c") and ("a", "bc") differ
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _llm_cache_entry(cache: DiskCache, key: str) -> dict | None:
+    raw = cache.get(key)
+    if raw is None:
+        return None
+    try:
+        entry = json.loads(raw)
+    except ValueError:
+        return None
+    if time.time() - entry.get("created", 0) > LLM_CACHE_TTL:
+        return None
+    return entry
+
+
+def llm_cache_get(key: str) -> str | None:
+    cache = llm_cache()
+    entry = _llm_cache_entry(cache, key) if cache else None
+    if not entry or (LLM_CACHE_ONLY_VALIDATED and not entry.get("validated")):
+        return None
+    return entry.get("text")
+
+
+def llm_cache_put(key: str, model_name: str, text: str) -> None:
+    cache = llm_cache()
+    if not cache or not text:
+        return
+    entry = {"created": time.time(), "model": model_name, "text": text, "validated": False}
+    cache.put(key, json.dumps(entry).encode("utf-8"))
+    cache.evict()
+
+
+def llm_cache_mark_validated(key: str) -> None:
+    """Flag a cached response whose patch passed the tests, making it servable in validated-only mode."""
+    cache = llm_cache()
+    entry = _llm_cache_entry(cache, key) if cache else None
+    if entry and not entry.get("validated"):
+        entry["validated"] = True
+        cache.put(key, json.dumps(entry).encode("utf-8"))
+
+
+# -------- diff extraction
+
+# Blocks scoring below this are ignored by extract_diff_block()
+DIFF_MIN_CONFIDENCE = float(os.environ.get("DIFF_MIN_CONFIDENCE", "0.5"))
+FENCE_RE = re.compile(r"^ {0,3}(`{3,}|~{3,})[ \t]*([^`\s]*)")
+DIFF_FENCE_LANGS = {"diff", "patch", "udiff", "git"}
+DIFF_META_RE = re.compile(
+    r"^(?:diff --git |index [0-9a-f]|(?:new|deleted) file mode |(?:old|new) mode |"
+    r"similarity index |dissimilarity index |rename (?:from|to) |copy (?:from|to) |Binary files )"
+)
+GIT_DIFF_HEADER_RE = re.compile(r"^diff --git \S+ (\S+)")
+COUNTED_HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+# A sentence or markdown bullet ("- This removes foo."): where a hunk without line counts ends
+PROSE_RE = re.compile(r"^(?:[-*+] +)?[A-Z][a-z']*(?: +[\w'`\"(),.:;-]+){2,}\s*$")
+# Summary entries printed by extract_diff_block()
+DIFF_SCAN_SUMMARY_MAX = 5
+
+
+def _file_key(path: str) -> str:
+    return re.sub(r"^[ab]/", "", path.split("\t")[0].strip())
+
+
+class DiffBlock:
+    """
+    One diff-like run of lines in a model reply, split into per-file sections.
+    `source` is "fence:<lang>" or "bare"; confidence (0..1) is set by finish().
+    """
+
+    def __init__(self, source: str, line_no: int):
+        self.source = source
+        self.line_no = line_no
+        self.unterminated = False  # its diff fence never closed
+        self.truncated = False     # the reply ended while the block was still open
+        self.sections: List[Tuple[str, List[str]]] = []  # (file key, lines)
+        self.confidence = 0.0
+        self._old = self._new = 0  # lines left in the current hunk per its header; -1: unknown
+        self._hunks = self._bare = self._bad_counts = self._prose = 0
+
+    @property
+    def files(self) -> List[str]:
+        return [key for key, _ in self.sections]
+
+    def _add(self, line: str) -> None:
+        self.sections[-1][1].append(line)
+
+    def feed(self, line: str, nxt: str) -> bool:
+        """Take `line` (followed by `nxt`) if it continues this diff."""
+        if self._old > 0 or self._new > 0:
+            tag = line[:1] or " "  # blank lines usually lost their context space
+            if tag in " -+\\":
+                if tag in " -":
+                    self._old -= 1
+                if tag in " +":
+                    self._new -= 1
+                if self._old < 0 or self._new < 0:
+                    self._bad_counts += 1
+                    self._old = self._new = -1
+                self._add(line)
+                return True
+            # the header promised more lines than came
+            self._bad_counts += 1
+            self._old = self._new = -1
+        if line.startswith("diff --git "):
+            m = GIT_DIFF_HEADER_RE.match(line)
+            self.sections.append((_file_key(m.group(1)) if m else "", []))
+            self._old = self._new = 0
+            self._add(line)
+            return True
+        if line.startswith("--- ") and nxt.startswith("+++ "):
+            # continues a `diff --git` header that has no ---/+++ or hunks yet
+            cur = self.sections[-1][1] if self.sections else []
+            if not (cur and cur[0].startswith("diff --git ") and not any(l.startswith(("@@", "+++ ")) for l in cur)):
+                self.sections.append(("", []))
+            self._old = self._new = 0
+            self._add(line)
+            return True
+        if not self.sections:
+            return False
+        if line.startswith("+++ ") and self.sections[-1][1][-1].startswith("--- "):
+            old = self.sections[-1][1][-1][4:]
+            path = line[4:] if line[4:].strip() != "/dev/null" else old
+            self.sections[-1] = (_file_key(path), self.sections[-1][1])
+            self._add(line)
+            return True
+        if line.startswith("@@"):
+            self._hunks += 1
+            m = COUNTED_HUNK_RE.match(line)
+            if m:
+                self._old = int(m.group(2) or 1)
+                self._new = int(m.group(4) or 1)
+            else:
+                self._bare += 1
+                self._old = self._new = -1
+            self._add(line)
+            return True
+        if DIFF_META_RE.match(line):
+            self._add(line)
+            return True
+        if self._old == -1 and line[:1] in ("", " ", "-", "+", "\\"):
+            if not line and PROSE_RE.match(nxt):
+                return False  # a blank line, then prose: the uncounted hunk is over
+            if line[:2] in ("- ", "+ ") and PROSE_RE.match(line):
+                self._prose += 1
+            self._add(line)
+            return True
+        return False
+
+    def finish(self) -> "DiffBlock":
+        incomplete = self._old > 0 or self._new > 0
+        if incomplete:
+            self._bad_counts += 1  # the block ended inside a hunk
+        for key, lines in self.sections:
+            while lines and not lines[-1].strip():
+                lines.pop()
+        self.sections = [(key, lines) for key, lines in self.sections if key and lines]
+        if not self.sections:
+            self.confidence = 0.0
+            return self
+        lang = self.source.partition(":")[2]
+        score = 0.95 if lang in DIFF_FENCE_LANGS else 0.75 if self.source.startswith("fence") else 0.65
+        if self._hunks:
+            score -= 0.2 * self._bad_counts / self._hunks + 0.1 * self._bare / self._hunks
+        if self._prose:
+            score -= 0.3  # bullet-like +/- lines in an uncounted hunk are likely trailing prose
+        if self.unterminated:
+            score -= 0.1
+        if (self.truncated or self.unterminated) and (incomplete or (self.unterminated and self._old == -1)):
+            # cut off mid-hunk (or with no counts to tell): applying it would drop the missing lines
+            score = 0.0
+        self.confidence = round(max(0.0, min(1.0, score)), 3)
+        return self
+
+
+class DiffScanner:
+    """
+    Incremental form of scan_diff_blocks(): push() lines as they arrive (one
+    line of lookahead is held back), close() at the end of the reply.
+    Finished blocks with at least one file section collect in `blocks`.
+    """
+
+    def __init__(self):
+        self.blocks: List[DiffBlock] = []
+        self.fences: List[Tuple[str, str]] = []  # open (marker, lang), innermost last
+        self.cur: DiffBlock | None = None
+        self._pending: str | None = None
+        self._n = 0
+
+    @property
+    def in_diff(self) -> bool:
+        """Inside a diff block or an open diff fence, i.e. more of the diff may follow."""
+        return self.cur is not None or bool(self.fences and self.fences[-1][1] in DIFF_FENCE_LANGS)
+
+    def push(self, line: str) -> None:
+        if self._pending is not None:
+            self._step(self._pending, line)
+        self._pending = line
+
+    def close(self) -> List[DiffBlock]:
+        if self._pending is not None:
+            self._step(self._pending, "")
+            self._pending = None
+        if self.cur is not None:
+            self.cur.truncated = True
+        self._close(unterminated=bool(self.fences) and self.fences[-1][1] in DIFF_FENCE_LANGS)
+        return self.blocks
+
+    def _close(self, unterminated: bool = False) -> None:
+        if self.cur is not None:
+            self.cur.unterminated = unterminated
+            if self.cur.finish().sections:
+                self.blocks.append(self.cur)
+            self.cur = None
+
+    def _step(self, line: str, nxt: str) -> None:
+        self._n += 1
+        fences = self.fences
+        m = FENCE_RE.match(line)
+        if m and fences and fences[-1][1] in DIFF_FENCE_LANGS:
+            # inside a diff only an unindented fence as long as the opener is markup; " ```" is context
+            if line[:1] != m.group(1)[0] or len(m.group(1)) < len(fences[-1][0]):
+                m = None
+        if m:
+            marker, lang = m.group(1), m.group(2).lower()
+            if fences and not lang and marker[0] == fences[-1][0][0] and len(marker) >= len(fences[-1][0]):
+                self._close()
+                fences.pop()
+                return
+            if fences and fences[-1][1] in DIFF_FENCE_LANGS:
+                # no diff line looks like a fence: the previous diff fence was never closed
+                self._close(unterminated=True)
+                fences.pop()
+            self._close()
+            fences.append((marker, lang))
+            return
+        if self.cur is not None and self.cur.feed(line, nxt):
+            return
+        self._close()
+        self.cur = DiffBlock(f"fence:{fences[-1][1]}" if fences else "bare", self._n)
+        if not self.cur.feed(line, nxt):
+            self.cur = None
+
+
+def scan_diff_blocks(text: str) -> List[DiffBlock]:
+    """
+    Every diff-like block in a model reply, in one pass over its lines: ```diff
+    / ```patch / other fences, fences nested in other fences, unterminated
+    fences and bare `diff --git` / `---`+`+++` output. Hunk line counts, when
+    present, decide where a bare diff ends and prose starts.
+    """
+    scanner = DiffScanner()
+    for line in text.splitlines():
+        scanner.push(line)
+    return scanner.close()
+
+
+def merge_diff_blocks(blocks: List[DiffBlock]) -> str:
+    """
+    One diff from many blocks: a file's sections are merged under its first
+    header. A repeated hunk (same old start and length) keeps the later version,
+    since models restate fixes they revised.
+    """
+    files: dict = {}  # file key -> (header lines, {hunk id: hunk lines})
+    for block in blocks:
+        for key, lines in block.sections:
+            cut = next((i for i, l in enumerate(lines) if l.startswith("@@")), len(lines))
+            header, hunks = files.setdefault(key, (lines[:cut], {}))
+            hunk: List[str] = []
+            for line in lines[cut:] + ["@@"]:
+                if line.startswith("@@") and hunk:
+                    m = COUNTED_HUNK_RE.match(hunk[0])
+                    hunk_id = (m.group(1), m.group(2)) if m else "\n".join(hunk)
+                    hunks.pop(hunk_id, None)
+                    hunks[hunk_id] = hunk
+                    hunk = []
+                hunk.append(line)
+    out: List[str] = []
+    for header, hunks in files.values():
+        out.extend(header)
+        ordered = list(hunks.items())
+        if all(isinstance(h, tuple) for h, _ in ordered):
+            ordered.sort(key=lambda item: int(item[0][0]))
+        for _, hunk in ordered:
+            out.extend(hunk)
+    return "\n".join(out)
+
+
 def extract_diff_block(s: str) -> str:
-    """Extract the first ```diff ...``` fenced block."""
+    """
+    The reply's diff: every block scan_diff_blocks() finds at
+    DIFF_MIN_CONFIDENCE or above, merged per file ("" if none).
+    """
     if not s:
         return ""
-    start = s.find("```diff")
-    if start == -1:
-        return ""
-    start = s.find("\n", start)
-    if start == -1:
-        return ""
-    end = s.find("```", start)
-    if end == -1:
-        return ""
-    return s[start + 1:end].strip()
+    blocks = scan_diff_blocks(s)
+    kept = [b for b in blocks if b.confidence >= DIFF_MIN_CONFIDENCE]
+    if len(blocks) > 1 or (blocks and blocks[0].source == "bare"):
+        shown = ", ".join(f"{b.source}@{b.line_no} {len(b.files)} file(s) conf={b.confidence}"
+                          for b in blocks[:DIFF_SCAN_SUMMARY_MAX])
+        more = f", ... {len(blocks) - DIFF_SCAN_SUMMARY_MAX} more" if len(blocks) > DIFF_SCAN_SUMMARY_MAX else ""
+        print(f"diff scan: {len(blocks)} block(s), {len(kept)} kept: {shown}{more}")
+    return merge_diff_blocks(kept).strip()
+
+
+# -------- in-process patch engine
+
+# python: apply LLM diffs with the fuzzy in-process engine, falling back to git apply; git: git apply only
+PATCH_ENGINE = os.environ.get("PATCH_ENGINE", "python")
+# Context lines a hunk may lose at either end while still being placed (like patch(1) --fuzz)
+PATCH_FUZZ = int(os.environ.get("PATCH_FUZZ", "2"))
+HUNK_START_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))?")
+# git features the engine leaves to git apply
+UNSUPPORTED_PATCH_RE = re.compile(r"^(?:GIT binary patch|Binary files |rename from |copy from |(?:old|new) mode )", re.M)
+
+
+class PatchError(Exception):
+    """A diff the in-process engine cannot parse or place; `reasons` lists the failing hunks."""
+
+    def __init__(self, message: str, reasons: List[str] | None = None):
+        super().__init__(message)
+        self.reasons = reasons or [message]
+
+
+class Hunk:
+    """One @@ block as (tag, text) lines; old_start is the 1-based header hint (0 for a bare @@)."""
+
+    def __init__(self, header: str, index: int):
+        self.header = header
+        self.index = index
+        m = HUNK_START_RE.match(header)
+        self.old_start = int(m.group(1)) if m else 0
+        # 0-based index the old range starts at; an empty range (`-N,0`, as in `git diff -U0`) inserts after line N
+        self.old_at = self.old_start if m and m.group(2) == "0" else self.old_start - 1
+        self.lines: List[Tuple[str, str]] = []
+        self.old_noeol = self.new_noeol = False
+
+    def trimmed(self, fuzz: int) -> List[Tuple[str, str]]:
+        """lines minus up to `fuzz` context lines at each end."""
+        lines = self.lines
+        lead = 0
+        while lead < min(fuzz, len(lines)) and lines[lead][0] == " ":
+            lead += 1
+        tail = 0
+        while tail < min(fuzz, len(lines) - lead) and lines[-1 - tail][0] == " ":
+            tail += 1
+        return lines[lead:len(lines) - tail]
+
+
+class FilePatch:
+    def __init__(self, old_path: str, new_path: str):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks: List[Hunk] = []
+
+    @property
+    def path(self) -> str:
+        return self.old_path if self.new_path == "/dev/null" else self.new_path
+
+
+def parse_unified_diff(diff_text: str) -> List[FilePatch]:
+    """
+    Parse a (possibly sloppy) unified diff: bare @@ headers, wrong hunk counts
+    and blank lines that lost their leading space are all accepted; a hunk
+    runs until the next @@, file header or non-diff line.
+    """
+    if UNSUPPORTED_PATCH_RE.search(diff_text):
+        raise PatchError("binary, rename or mode change; left to git apply")
+    strip = patch_strip(diff_text)
+    lines = diff_text.splitlines()
+    files: List[FilePatch] = []
+    cur: FilePatch | None = None
+    hunk: Hunk | None = None
+
+    def path_of(header: str) -> str:
+        name = header[4:].split("\t")[0].strip()
+        return name if name == "/dev/null" else name.split("/", strip)[-1]
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if line.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ "):
+            cur = FilePatch(path_of(line), path_of(lines[i + 1]))
+            files.append(cur)
+            hunk = None
+            i += 2
+            continue
+        if line.startswith("@@"):
+            if cur is None:
+                raise PatchError(f"hunk before any file header: {line}")
+            hunk = Hunk(line, len(cur.hunks) + 1)
+            cur.hunks.append(hunk)
+        elif hunk is not None and line[:1] in (" ", "-", "+", ""):
+            hunk.lines.append((line[:1] or " ", line[1:]))
+        elif hunk is not None and line.startswith("\\"):
+            tag = hunk.lines[-1][0] if hunk.lines else " "
+            hunk.old_noeol |= tag in " -"
+            hunk.new_noeol |= tag in " +"
+        else:
+            hunk = None  # "diff --git", "index ...", or prose between files
+        i += 1
+    for fp in files:
+        for h in fp.hunks:
+            # trailing blank "context" is usually the gap before the next file header
+            while h.lines and h.lines[-1] == (" ", ""):
+                h.lines.pop()
+        fp.hunks = [h for h in fp.hunks if h.lines]
+    if not files:
+        raise PatchError("no file headers found")
+    return files
+
+
+def _norm_ws(line: str) -> str:
+    return " ".join(line.split())
+
+
+def _locate(lines: List[str], index: dict, block: List[str], floor: int, hint: int, norm) -> int:
+    """
+    Start of `block` in lines[floor:] nearest to hint, or -1. Candidates come
+    from the block's rarest line in `index` (line -> positions), so the search
+    is linear in the file plus the few places that line occurs.
+    """
+    if not block:
+        return min(max(hint, floor), len(lines))
+    keys = [norm(b) for b in block]
+    k = min(range(len(keys)), key=lambda j: (not keys[j], len(index.get(keys[j], ()))))
+    best = -1
+    for pos in index.get(keys[k], ()):
+        start = pos - k
+        if start < floor or start + len(block) > len(lines):
+            continue
+        if best != -1 and abs(start - hint) >= abs(best - hint):
+            continue
+        if all(norm(lines[start + j]) == keys[j] for j in range(len(keys))):
+            best = start
+    return best
+
+
+def patch_text(text: str, fp: FilePatch) -> str:
+    """Apply fp's hunks to text in memory; exact matches first, then whitespace-insensitive, then with fuzz."""
+    newline = "\r\n" if "\r\n" in text else "\n"
+    lines = text.splitlines()
+    eol = text.endswith(("\n", "\r")) or not text
+    indexes: dict = {}
+
+    def index_for(norm) -> dict:
+        if norm not in indexes:
+            idx: dict = {}
+            for n, line in enumerate(lines):
+                idx.setdefault(norm(line), []).append(n)
+            indexes[norm] = idx
+        return indexes[norm]
+
+    out: List[str] = []
+    floor = drift = 0
+    reasons = []
+    for h in fp.hunks:
+        hint = h.old_at + drift if h.old_start else floor
+        for fuzz in range(PATCH_FUZZ + 1):
+            body = h.trimmed(fuzz)
+            old = [t for tag, t in body if tag != "+"]
+            if fuzz and not old:
+                break  # all context trimmed away: nothing left to anchor on
+            start = -1
+            for norm in (str, _norm_ws):
+                start = _locate(lines, index_for(norm), old, floor, hint, norm)
+                if start != -1:
+                    break
+            if start != -1:
+                break
+        if start == -1:
+            reasons.append(f"{fp.path} hunk #{h.index} ({h.header.strip()}): context not found")
+            continue
+        if h.old_start:
+            drift = start - h.old_at
+        out.extend(lines[floor:start])
+        j = start
+        for tag, t in body:
+            if tag == " ":
+                out.append(lines[j])  # keep the file's own whitespace
+                j += 1
+            elif tag == "-":
+                j += 1
+            else:
+                out.append(t)
+        floor = j
+        if j == len(lines) and (h.old_noeol or h.new_noeol):
+            eol = not h.new_noeol
+    if reasons:
+        raise PatchError(f"{len(reasons)} hunk(s) failed in {fp.path}", reasons)
+    out.extend(lines[floor:])
+    return newline.join(out) + (newline if eol and out else "")
+
+
+def apply_in_process(diff_text: str, root: Path = ROOT) -> List[str]:
+    """
+    Parse and apply diff_text to root entirely in memory; files are written
+    (atomically, keeping their mode) only once every hunk of every file has
+    been placed. Returns the repo paths touched.
+    """
+    root = root.resolve()
+    results: dict = {}
+    reasons: List[str] = []
+    for fp in parse_unified_diff(diff_text):
+        target = (root / fp.path).resolve()
+        if root not in target.parents:
+            raise PatchError(f"path escapes the repository: {fp.path}")
+        if fp.path in results:
+            base = results[fp.path]
+        elif fp.old_path == "/dev/null":
+            if target.exists():
+                raise PatchError(f"{fp.path} already exists")
+            base = ""
+        else:
+            try:
+                with open(target, encoding="utf-8", newline="") as f:
+                    base = f.read()
+            except FileNotFoundError:
+                raise PatchError(f"{fp.path} does not exist")
+            except (OSError, UnicodeDecodeError) as e:
+                raise PatchError(f"cannot read {fp.path}: {e}")
+        try:
+            results[fp.path] = None if fp.new_path == "/dev/null" else patch_text(base, fp)
+        except PatchError as e:
+            reasons.extend(e.reasons)
+    if reasons:
+        raise PatchError(f"{len(reasons)} hunk(s) did not apply", reasons)
+
+    for rel, text in results.items():
+        target = root / rel
+        if text is None:
+            target.unlink(missing_ok=True)
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".heal-")
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        if target.exists():
+            shutil.copymode(target, tmp)
+        os.replace(tmp, target)
+    return sorted(results)
 
 
 # -------- Patch + test
 
-def apply_patch(diff_text: str) -> bool:
+# git apply strategies, most conservative first: staged, working tree only, 3-way merge
+PATCH_STRATEGIES = (("index", ["--index"]), ("plain", []), ("3way", ["--3way"]))
+PATCH_FAILED_RE = re.compile(r"^error: patch failed: (.+):(\d+)$")
+PATCH_NOISE_RE = re.compile(r"^error: (?:while searching for:|.+: patch does not apply$)")
+
+
+def patch_strip(diff_text: str) -> int:
+    """-p level for diff_text: 1 when every path carries git's a/ b/ prefixes, else 0."""
+    paths = [p for p in re.findall(r"^(?:---|\+\+\+) (\S+)", diff_text, re.M) if p != "/dev/null"]
+    return 1 if paths and all(p.startswith(("a/", "b/")) for p in paths) else 0
+
+
+def rejection_reasons(diff_text: str, out: str, strip: int) -> List[str]:
+    """Per-hunk reasons from `git apply --check` output; other errors are passed through."""
+    hunks: dict = {}
+    old = path = ""
+    n = 0
+    for line in diff_text.splitlines():
+        if line.startswith("--- "):
+            old = line[4:].split("\t")[0]
+        elif line.startswith("+++ "):
+            new_path = line[4:].split("\t")[0]
+            path = (new_path if old == "/dev/null" else old).split("/", strip)[-1]
+            n = 0
+        elif line.startswith("@@"):
+            n += 1
+            m = re.match(r"@@ -(\d+)", line)
+            if m:
+                hunks[(path, int(m.group(1)))] = f"hunk #{n} ({line.split(' @@')[0]} @@)"
+    reasons = []
+    for line in out.splitlines():
+        m = PATCH_FAILED_RE.match(line)
+        if m:
+            hunk = hunks.get((m.group(1), int(m.group(2))), f"hunk at line {m.group(2)}")
+            reasons.append(f"{m.group(1)} {hunk}: context does not match the file")
+        elif line.startswith("error: ") and not PATCH_NOISE_RE.match(line):
+            reasons.append(line[len("error: "):])
+    return reasons
+
+
+def preflight_patch(diff_text: str, root: Path = ROOT) -> Tuple[List[str] | None, List[str]]:
+    """
+    `git apply --check` each strategy with the patch on stdin, touching nothing.
+    Returns (git apply args of the first strategy that would apply, or None;
+    rejection reasons of the first failing check).
+    """
+    strip = f"-p{patch_strip(diff_text)}"
+    reasons: List[str] = []
+    for name, flags in PATCH_STRATEGIES:
+        args = flags + ["--whitespace=nowarn", strip]
+        code, out = run_cap(["git", "apply", "--check"] + args, cwd=root, input=diff_text)
+        if code == 0:
+            print(f"patch preflight: '{name}' strategy applies")
+            return args, reasons
+        if not reasons:
+            reasons = rejection_reasons(diff_text, out, int(strip[2:])) or out.strip().splitlines()[-1:]
+    return None, reasons
+
+
+def apply_patch(diff_text: str, root: Path = ROOT) -> bool:
+    """
+    Apply diff_text to the checkout at root (the main checkout by default):
+    in process first (PATCH_ENGINE=python), else with the first git apply
+    strategy preflight_patch() finds will work; either way nothing is written
+    to the tree until the whole patch is known to apply.
+    """
     # Return early if the LLM produced an empty/whitespace-only diff
     if not diff_text.strip():
         return False
-
-    # We *create* the patch file; don't check existence before writing
-    tmp = ROOT / "auto_fix.patch"
     if DISABLE_HEAL_PATCH:
         print("Patch mode disabled; skipping")
         return False
 
-    tmp.write_text(diff_text, encoding="utf-8")
-
-    # Try several strategies to apply the patch
-    code, out = run_cap(["git", "apply", "--index", "--whitespace=nowarn", "-p0", str(tmp)])
+    # extract_diff_block() strips the block; git apply rejects a last hunk line without its newline
+    if not diff_text.endswith("\n"):
+        diff_text += "\n"
+    if PATCH_ENGINE == "python":
+        try:
+            paths = apply_in_process(diff_text, root)
+        except PatchError as e:
+            print(f"in-process apply failed ({e}); trying git apply:")
+            for reason in e.reasons:
+                print(f"  - {reason}")
+        else:
+            # stage like `git apply --index`, so new files are part of the fix
+            run_cap(["git", "add", "-A", "--"] + paths, cwd=root)
+            print(f"patch applied in process to {len(paths)} file(s)")
+            return True
+    args, reasons = preflight_patch(diff_text, root)
+    if args is None:
+        print("Patch failed to apply:")
+        for reason in reasons:
+            print(f"  - {reason}")
+        return False
+    code, out = run_cap(["git", "apply"] + args, cwd=root, input=diff_text)
     if code != 0:
-        code, out = run_cap(["git", "apply", "--whitespace=nowarn", "-p0", str(tmp)])
-        if code != 0:
-            code, out = run_cap(["git", "apply", "--3way", "--whitespace=nowarn", "-p0", str(tmp)])
-            if code != 0:
-                print("Patch failed to apply.")
-                return False
+        print(f"Patch failed to apply after a passing preflight:\n{out}")
+        return False
+    return True
 
-    # Best effort: remove patch file after successful apply
-    try:
-        tmp.unlink(missing_ok=True)  # Python 3.8+: missing_ok supported on Path.unlink?
-    except TypeError:
-        try:
-            if tmp.exists():
-                tmp.unlink()
-        except Exception:
-            pass
-    except Exception:
-        pass
 
-    return True
+# Files whose change invalidates `npm ci` / the web build left warm by run_tests()
+INSTALL_INPUTS = ("app/package.json", "app/package-lock.json", "app/.npmrc")
+TEST_FILE_RE = re.compile(r"(?:^|/)(?:__tests__|__mocks__)/|\.(?:test|spec)\.[cm]?[jt]sx?$")
+
+
+class WarmState:
+    """What earlier run_tests() calls left valid in a tree: installed deps and built web assets."""
+
+    def __init__(self):
+        self.installed = False
+        self.built = False
+        self.output = ""  # output of the step that failed last
+
+    def invalidate(self, changed: Iterable[str]) -> None:
+        """Forget steps whose inputs are among the changed repo paths."""
+        for rel in changed:
+            if rel in INSTALL_INPUTS:
+                self.installed = False
+            if rel.startswith("app/") and not TEST_FILE_RE.search(rel):
+                self.built = False
 
 
-def run_tests() -> bool:
+def run_tests(root: Path = ROOT, cancel: threading.Event | None = None, warm: WarmState | None = None) -> bool:
+    """
+    npm ci, build, jest in root/app; `cancel` aborts the running step. With
+    `warm`, install/build steps still valid from the previous call are skipped.
+    """
+    warm = warm if warm is not None else WarmState()
+    app_dir = root / "app"
     # 1) install
-    code, out = run_cap(["npm", "ci"], cwd=APP_DIR)
-    print(out)
-    if code != 0:
-        return False
+    if warm.installed:
+        print("dependencies unchanged; reusing node_modules")
+    else:
+        code, out = run_cap(["npm", "ci"], cwd=app_dir, cancel=cancel)
+        print(out)
+        if code != 0:
+            warm.output = out
+            return False
+        warm.installed, warm.built = True, False
 
     # 2) build web (if present)
-    pkg = json.loads((APP_DIR / "package.json").read_text(encoding="utf-8"))
-    if pkg.get("scripts", {}).get("build:web"):
-        code_b, out_b = run_cap(["npm", "run", "build:web"], cwd=APP_DIR)
+    pkg = json.loads((app_dir / "package.json").read_text(encoding="utf-8"))
+    if warm.built:
+        print("build inputs unchanged; reusing web build")
+    elif pkg.get("scripts", {}).get("build:web"):
+        code_b, out_b = run_cap(["npm", "run", "build:web"], cwd=app_dir, cancel=cancel)
         print(out_b)
         if code_b != 0:
+            warm.output = out_b
             return False
+        warm.built = True
+    else:
+        warm.built = True
 
     # 3) run tests (prefer jest+junit; fall back to npm test)
     env = os.environ.copy()
-    env["JEST_JUNIT_OUTPUT"] = str(APP_DIR / "junit.xml")
-    jest_bin = APP_DIR / "node_modules" / ".bin" / "jest"
+    env["JEST_JUNIT_OUTPUT"] = str(app_dir / "junit.xml")
+    jest_bin = app_dir / "node_modules" / ".bin" / "jest"
     if jest_bin.exists():
         code_t, out_t = run_cap(
             ["npx", "jest", "--runInBand", "--reporters=default", "--reporters=jest-junit"],
-            cwd=APP_DIR,
+            cwd=app_dir,
             env=env,
+            cancel=cancel,
         )
-        print(out_t)
-        return code_t == 0
     else:
-        code_t2, out_t2 = run_cap(["npm", "test"], cwd=APP_DIR, env=env)
-        print(out_t2)
-        return code_t2 == 0
+        code_t, out_t = run_cap(["npm", "test"], cwd=app_dir, env=env, cancel=cancel)
+    print(out_t)
+    warm.output = out_t
+    return code_t == 0
 
 
 def push_autofix_branch() -> None:
@@ -313,7 +2635,6 @@ def push_autofix_branch() -> None:
 # --- Deployment Investigation ---
 
 import shlex
-from datetime import datetime
 
 # Environment knobs (fallbacks)
 DEPLOY_NAMESPACE = os.environ.get("DEPLOY_NAMESPACE", "default")
@@ -417,22 +2738,10 @@ def find_commits_touching_paths(paths: List[str], n: int = 5) -> List[dict]:
 
 def find_commits_touching_manifests(n: int = 5) -> List[dict]:
     pats = ["k8s", "kubernetes", "deploy", "manifests", ".github/workflows", "Dockerfile", "app/Dockerfile"]
-    paths = []
-    for p in pats:
-        for f in ROOT.rglob(f"{p}/*"):
-            try:
-                rel = f.relative_to(ROOT)
-            except Exception:
-                continue
-            if rel.is_file():
-                paths.append(str(rel))
+    paths = [str(rel) for rel in discover_files([f"{p}/*" for p in pats], CONTEXT_TREEISH)]
     if not paths:
         # fallback: look at top-level k8s yaml files
-        for f in ROOT.glob("*.yaml"):
-            try:
-                paths.append(str(f.relative_to(ROOT)))
-            except Exception:
-                continue
+        paths = [f for f in candidate_files(CONTEXT_TREEISH) if "/" not in f and f.endswith(".yaml")]
     if not paths:
         return []
     # limit to a handful paths to keep git quick
@@ -473,6 +2782,7 @@ def investigate_deployment_failure(namespace: str | None = None, selector: str |
 
     failed = list_failed_deployments(sel)
     result["failed_deployments"] = failed
+    log_stats: dict = {}
 
     for d in failed:
         info = {"images": [], "pods": [], "pod_info": [], "candidate_commits": []}
@@ -483,7 +2793,9 @@ def investigate_deployment_failure(namespace: str | None = None, selector: str |
         info["pods"] = pods
 
         for p in pods:
-            info["pod_info"].append(describe_pod_and_logs(p))
+            podi = describe_pod_and_logs(p)
+            podi["logs"] = condense_text(podi["logs"], log_stats)
+            info["pod_info"].append(podi)
 
         # candidate commits: by image -> if image contains sha, add that commit
         candidate_commits = []
@@ -520,6 +2832,8 @@ def investigate_deployment_failure(namespace: str | None = None, selector: str |
         info["candidate_commits"] = candidate_commits
         result["per_deployment"][d] = info
 
+    print_condense_stats("pod logs", log_stats)
+
     # print a human-friendly summary
     print("\n--- Deployment investigation summary ---")
     if not failed:
@@ -602,44 +2916,585 @@ def fallback_heuristics() -> bool:
 
 # -------- main
 
-def build_llm_prompt() -> str:
-    logs = read_ci_logs()
-    code = read_code_context()
+def build_deploy_block(budget_tokens: int = 12_500) -> Tuple[str, str]:
+    """
+    Run the deployment investigation; return (prompt block, raw pod describe/log text).
+    The summary is truncated to budget_tokens.
+    The full JSON is saved to ci-logs/deploy-investigation.json for artifacts/debugging.
+    """
+    try:
+        ns = os.environ.get("DEPLOY_NAMESPACE", "default")
+        sel = os.environ.get("DEPLOY_SELECTOR", "")
+        inv = investigate_deployment_failure(namespace=ns, selector=sel)
+
+        # Save full JSON for artifacts/debugging
+        (ROOT / "ci-logs").mkdir(exist_ok=True)
+        (ROOT / "ci-logs" / "deploy-investigation.json").write_text(json.dumps(inv, indent=2), encoding="utf-8")
+
+        # Create a concise human summary to append to the prompt (truncate to keep prompt small)
+        summary = []
+        pod_text = []
+        failed = inv.get("failed_deployments", [])
+        if not failed:
+            summary.append("DEPLOYMENT INVESTIGATION: no failed deployments found.")
+        else:
+            for d in failed:
+                info = inv["per_deployment"].get(d, {})
+                imgs = info.get("images", [])
+                summary.append(f"Deployment {d} failed. Images: " + ",".join([f"{n}:{i}" for n, i in imgs]))
+                pods = info.get("pods", [])[:5]
+                summary.append("  Pods: " + ",".join(pods) if pods else "  No pods found")
+                # candidate commits (brief)
+                cands = info.get("candidate_commits", [])[:3]
+                for c in cands:
+                    if c.get("reason") == "image-sha" and c.get("commit"):
+                        cm = c["commit"]
+                        summary.append(f"  Candidate commit (image tag): {cm.get('hash')} - {cm.get('subject')}")
+                    elif c.get("reason") == "manifest-change":
+                        for cm in c.get("commits", [])[:2]:
+                            summary.append(f"  Manifest changed in {cm.get('hash')} - {cm.get('subject')}")
+                for podi in info.get("pod_info", []):
+                    pod_text.append(podi.get("describe", ""))
+                    pod_text.append(podi.get("logs", ""))
+        header = "\n\nDEPLOYMENT INVESTIGATION SUMMARY:\n"
+        deploy_block = truncate_to_tokens("\n".join(summary), budget_tokens - estimate_tokens(header))
+        return header + deploy_block, "\n".join(pod_text)
+
+    except Exception as e:
+        return f"\n\nDEPLOYMENT INVESTIGATION FAILED: {e}\n", ""
+
+
+def current_tree_hash() -> str:
+    code, out = run_cap(["git", "rev-parse", "HEAD^{tree}"])
+    return out.strip() if code == 0 else "unknown"
+
+
+def build_prompt_parts(budget: PromptBudget | None = None, anchor_text: str = "") -> Tuple[str, str]:
+    """
+    (stable prefix, volatile suffix). The prefix is the repo snapshot at a tree
+    hash, identical across heals of the same tree so it can be context-cached:
+    its order, excerpts and budget (the code share alone, no rollover) never
+    depend on the failure. The suffix carries the commit, failures, logs and
+    the focus section (ranking hints, plus the cited files the snapshot left
+    out or stubbed). Each section is built straight into its PromptBudget
+    allotment.
+    """
+    budget = budget or PromptBudget.for_model(os.environ.get("VERTEX_MODEL", "gemini-1.5-pro"))
+    failures = budget.spend("failures", read_failures())
+    logs = budget.spend("logs", read_ci_logs(budget.allot("logs")))
+    shown: set = set()
+    code = budget.spend("code", read_code_context(budget.share("code"), shown))
+    # failures in the reports and logs (and pod logs, if any) pick the files to focus on
+    anchors = extract_anchors(failures + "\n" + logs + "\n" + anchor_text)
+    focus = budget.spend("focus", read_focus_context(anchors, budget.allot("focus"), shown))
+    print(f"prompt budget: {budget.used} of {budget.total} tokens")
     repo = os.environ.get("GITHUB_REPOSITORY", "unknown/repo")
-    sha = current_sha_short()
-    return textwrap.dedent(f"""
-    REPOSITORY: {repo}
-    COMMIT: {sha}
+    prefix = (
+        f"REPOSITORY: {repo}\n"
+        f"TREE: {current_tree_hash()}\n\n"
+        f"CODE SNAPSHOT (paths relative to repo root):\n{code}\n"
+    )
+    suffix = (
+        f"COMMIT: {current_sha_short()}\n\n"
+        f"FAILURES:\n{failures if failures.strip() else '(no failing testcases in junit reports)'}\n\n"
+        f"CI LOGS:\n{logs if logs.strip() else '(no ci-logs found)'}\n"
+    )
+    if focus.strip():
+        suffix += f"\nFOCUS (snapshot files cited by the failures, most relevant first):\n{focus}\n"
+    return prefix, suffix
 
-    CI LOGS:
-    {logs if logs.strip() else "(no ci-logs found)"}
 
-    CODE SNAPSHOT (paths relative to repo root):
-    {code}
-    """)
+def build_llm_prompt(budget: PromptBudget | None = None, anchor_text: str = "") -> str:
+    prefix, suffix = build_prompt_parts(budget, anchor_text)
+    return prefix + "\n" + suffix
 
 
-def vertex_try(prompt: str) -> str:
-    """Isolate Vertex call so we can clearly fall back."""
-    from vertexai import init as vertex_init
-    from vertexai.generative_models import GenerativeModel
+HEAL_SYSTEM_PROMPT = textwrap.dedent("""
+You are an expert DevOps+Software agent. You are given CI logs and code snapshots.
+Return ONLY a unified diff patch inside a single ```diff fenced block``` that fixes the CI failure.
+""")
 
-    project = os.environ.get("GCP_PROJECT_ID")
-    location = os.environ.get("GCP_LOCATION")
-    model_name = os.environ.get("VERTEX_MODEL", "gemini-1.5-pro")
 
-    if not project or not location:
-        print("Missing GCP_PROJECT_ID or GCP_LOCATION")
-        raise SystemExit(6)
+def vertex_try(prompt: str, prefix: str = "", model_name: str | None = None) -> str:
+    """
+    Isolate Vertex call so we can clearly fall back. `prefix` is the stable part
+    (system rules + repo snapshot), `prompt` the volatile part. Identical
+    requests are served from the response cache.
+    """
+    model_name = model_name or default_model_name()
+    key = llm_cache_key(model_name, prefix, prompt)
+    cached = llm_cache_get(key)
+    if cached is not None:
+        print("LLM response cache hit; skipping model call")
+        finish_call_record(new_call_record(prefix + prompt, model_name), time.monotonic(), "response-cache-hit", cached)
+        return cached
+    tokens, limit = estimate_tokens(prefix) + estimate_tokens(prompt), model_context_tokens(model_name)
+    if tokens > limit:
+        raise PromptTooLong(f"prompt of ~{tokens} tokens exceeds {model_name}'s {limit}", limit / tokens)
+    try:
+        text = generate_with_prefix(prefix, prompt, model_name) if prefix else vertex_generate(prompt, model_name)
+    except Exception as e:
+        too_long = as_prompt_too_long(e)
+        if too_long is None:
+            raise
+        raise too_long from e
+    llm_cache_put(key, model_name, text)
+    return text
 
-    vertex_init(project=project, location=location)
-    model = GenerativeModel(model_name)
-    resp = model.generate_content(prompt)
-    text = getattr(resp, "text", None) or (
-        resp.candidates[0].content.parts[0].text
-        if getattr(resp, "candidates", None) else ""
+
+# -------- sandboxes
+
+# Most git worktree sandboxes alive at once (default: one per core)
+HEAL_SANDBOXES = int(os.environ.get("HEAL_SANDBOXES", "0")) or (os.cpu_count() or 2)
+# Untracked dirs that survive a sandbox reset, so installs/builds stay warm between trials
+SANDBOX_KEEP_DIRS = [d for d in os.environ.get("SANDBOX_KEEP_DIRS", "node_modules,dist,build").split(",") if d]
+
+
+class Sandbox:
+    """A detached worktree of the pool's base commit and what is still warm in it."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.warm = WarmState()
+        self.trials = 0
+
+
+class SandboxPool:
+    """
+    Detached `git worktree` checkouts of one commit, created on demand up to
+    max_size and reused: between trials a sandbox is reset to the base commit
+    (tracked edits and new files dropped, SANDBOX_KEEP_DIRS kept), so
+    apply_patch(root=sb.path) / run_tests(sb.path, warm=sb.warm) start clean
+    but warm.
+    """
+
+    def __init__(self, base: str = "HEAD", max_size: int = HEAL_SANDBOXES, root: Path = ROOT):
+        self.root = root
+        code, out = run_cap(["git", "rev-parse", "--verify", base + "^{commit}"], cwd=root)
+        if code != 0:
+            raise RuntimeError(f"cannot resolve {base}: {out.strip()}")
+        self.base = out.strip()
+        self.max_size = max(1, max_size)
+        self._all: List[Sandbox] = []
+        self._idle: List[Sandbox] = []
+        self._cond = threading.Condition()
+
+    def _create(self) -> Sandbox:
+        path = Path(tempfile.mkdtemp(prefix="heal-wt-"))
+        code, out = run_cap(["git", "worktree", "add", "--detach", str(path), self.base], cwd=self.root)
+        if code != 0:
+            shutil.rmtree(path, ignore_errors=True)
+            raise RuntimeError(f"git worktree add failed: {out.strip()}")
+        return Sandbox(path)
+
+    def acquire(self) -> Sandbox:
+        """An idle sandbox, a new one while under max_size, else wait for a release."""
+        with self._cond:
+            while not self._idle and len(self._all) >= self.max_size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._all.append(None)  # reserve the slot while the worktree is created
+        try:
+            sb = self._create()
+        except Exception:
+            with self._cond:
+                self._all.remove(None)
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._all[self._all.index(None)] = sb
+        return sb
+
+    def reset(self, sb: Sandbox) -> None:
+        """Back to the base commit; warm steps whose inputs the trial touched are invalidated."""
+        changed = git_paths(["diff", "--name-only", "HEAD"], sb.path)
+        untracked = git_paths(["ls-files", "--others", "--exclude-standard", "--directory"], sb.path)
+        keep = [rel for rel in untracked if Path(rel).name in SANDBOX_KEEP_DIRS]
+        excludes = [arg for d in SANDBOX_KEEP_DIRS for arg in ("-e", d)]
+        run_cap(["git", "reset", "-q", "--hard", self.base], cwd=sb.path)
+        run_cap(["git", "clean", "-fdq"] + excludes, cwd=sb.path)
+        sb.warm.invalidate(changed | (untracked - set(keep)))
+
+    def release(self, sb: Sandbox) -> None:
+        sb.trials += 1
+        try:
+            self.reset(sb)
+        except Exception as e:
+            print(f"sandbox reset failed ({e}); dropping {sb.path}")
+            self._remove(sb)
+            with self._cond:
+                self._all.remove(sb)
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append(sb)
+            self._cond.notify()
+
+    @contextmanager
+    def sandbox(self) -> Iterator[Sandbox]:
+        sb = self.acquire()
+        try:
+            yield sb
+        finally:
+            self.release(sb)
+
+    def _remove(self, sb: Sandbox) -> None:
+        run_cap(["git", "worktree", "remove", "--force", str(sb.path)], cwd=self.root)
+        shutil.rmtree(sb.path, ignore_errors=True)
+
+    def close(self) -> None:
+        with self._cond:
+            sandboxes, self._all, self._idle = [sb for sb in self._all if sb], [], []
+        for sb in sandboxes:
+            self._remove(sb)
+        run_cap(["git", "worktree", "prune"], cwd=self.root)
+
+
+# -------- multi-candidate healing
+
+# HEAL_CANDIDATES>1: ask for N diffs concurrently and validate each in a sandbox worktree
+HEAL_CANDIDATES = int(os.environ.get("HEAL_CANDIDATES", "1"))
+# Temperatures cycled across candidates
+HEAL_CANDIDATE_TEMPERATURES = [
+    float(t) for t in os.environ.get("HEAL_CANDIDATE_TEMPERATURES", "0.2,0.6,1.0").split(",") if t.strip()
+]
+
+
+def _generate_candidate(cand: dict, fitter: "PromptFitter") -> dict:
+    """Generate cand's diff from the fitter's current prompt, re-fitting if the model rejects it as too long."""
+    started = time.monotonic()
+    try:
+        while True:
+            prefix, suffix, level = fitter.fit()
+            try:
+                raw = generate_with_prefix(prefix, suffix, fitter.model_name,
+                                           generation_config={"temperature": cand["temperature"]})
+                break
+            except Exception as e:
+                too_long = as_prompt_too_long(e)
+                if too_long is None:
+                    raise
+                fitter.rejected(level, too_long)
+        cand["diff"] = extract_diff_block(raw)
+    except (Exception, SystemExit) as e:
+        cand["error"] = f"generate: {e}"
+        cand["diff"] = ""
+    cand["generate_s"] = time.monotonic() - started
+    return cand
+
+
+def _validate_candidate(cand: dict, sandboxes: SandboxPool, cancel: threading.Event) -> dict:
+    started = time.monotonic()
+    try:
+        with sandboxes.sandbox() as sb:
+            if cancel.is_set():
+                raise RuntimeError("cancelled")
+            cand["applied"] = apply_patch(cand["diff"], root=sb.path)
+            if cand["applied"]:
+                # a reused sandbox is warm from earlier trials, which predate this patch
+                sb.warm.invalidate(diff_paths(cand["diff"]))
+            cand["passed"] = cand["applied"] and not cancel.is_set() and run_tests(sb.path, cancel=cancel, warm=sb.warm)
+    except Exception as e:
+        cand["error"] = f"validate: {e}"
+        cand["passed"] = False
+    cand["validate_s"] = time.monotonic() - started
+    return cand
+
+
+def heal_candidates(model_name: str, deploy_block: str, pod_text: str, n: int) -> Tuple[dict | None, List[dict]]:
+    """
+    Generate n candidate diffs concurrently (cycling HEAL_CANDIDATE_TEMPERATURES)
+    from one prompt, fitted to the model's input limit up front; a candidate the
+    model turns away as too long re-fits it (shared by all) and retries. Each
+    diff is validated in a pooled sandbox (at most HEAL_SANDBOXES at once) as
+    soon as it arrives. The first candidate to pass wins and the remaining
+    validations are killed. Returns (winner or None, all candidates).
+    """
+    temps = HEAL_CANDIDATE_TEMPERATURES or [0.2]
+    cands = [{"index": i, "temperature": temps[i % len(temps)]} for i in range(n)]
+    cancel = threading.Event()
+    winner = None
+    sandboxes = SandboxPool(max_size=min(n, HEAL_SANDBOXES))
+    pool = ThreadPoolExecutor(max_workers=n)
+    try:
+        fitter = PromptFitter(model_name, 0, deploy_block, pod_text)
+        # generations run on daemon threads: once a candidate wins, slower model calls are abandoned, not awaited
+        pending = {_spawn(lambda c=c: _generate_candidate(c, fitter)) for c in cands}
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                cand = fut.result()
+                if "passed" in cand:
+                    if cand["passed"] and winner is None:
+                        winner = cand
+                elif cand["diff"]:
+                    pending.add(pool.submit(_validate_candidate, cand, sandboxes, cancel))
+    finally:
+        cancel.set()
+        # only validations are waited for; they notice `cancel` and stop
+        pool.shutdown(wait=True, cancel_futures=True)
+        sandboxes.close()
+
+    print("\n--- candidate summary ---")
+    for c in cands:
+        status = "PASS" if c.get("passed") else ("abandoned" if "diff" not in c else "no diff" if not c["diff"] else
+                                                 "not applied" if c.get("applied") is False else "fail/cancelled")
+        print(f"  #{c['index']} t={c['temperature']}: {status}; generate {c.get('generate_s', 0):.1f}s, "
+              f"validate {c.get('validate_s', 0):.1f}s {c.get('error', '')}")
+    return winner, cands
+
+
+# -------- multi-round repair
+
+# HEAL_ROUNDS>1: feed failing test output back for follow-up patches on top of the first
+HEAL_ROUNDS = int(os.environ.get("HEAL_ROUNDS", "1"))
+# Wall-clock budget for rounds after the first; no new round starts once it is spent
+HEAL_ROUNDS_BUDGET_S = float(os.environ.get("HEAL_ROUNDS_BUDGET_S", "600"))
+# Tokens of (condensed) test output sent back per round
+HEAL_FEEDBACK_TOKENS = int(os.environ.get("HEAL_FEEDBACK_TOKENS", "8000"))
+DIFF_PATH_RE = re.compile(r"^(?:\+\+\+|---) (?:[ab]/)?(\S+)", re.M)
+
+
+def diff_paths(diff_text: str) -> List[str]:
+    """Repo paths touched by a unified diff (old and new sides)."""
+    return sorted(set(DIFF_PATH_RE.findall(diff_text)) - {"/dev/null"})
+
+
+def repair_prompt(suffix: str, patches: List[str], test_output: str) -> str:
+    """Volatile part for a follow-up round: original findings, patches so far, and how tests fail now."""
+    applied = "\n".join(f"```diff\n{d.rstrip()}\n```" for d in patches)
+    feedback = truncate_to_tokens(condense_text(test_output), HEAL_FEEDBACK_TOKENS)
+    return (
+        f"{suffix}\n\n"
+        f"PATCHES ALREADY APPLIED (in order)\n{applied}\n\n"
+        f"TEST OUTPUT AFTER THESE PATCHES\n{feedback}\n\n"
+        "Tests still fail. Return ONE follow-up unified diff against the tree WITH the patches above applied. "
+        "Do not repeat changes that are already applied.\n"
     )
-    return text or ""
+
+
+def repair_rounds(prefix: str, suffix: str, diff: str, warm: WarmState, model_name: str | None = None) -> List[str]:
+    """
+    After `diff` is applied and run_tests(warm=warm) failed, ask for follow-up
+    patches on top, up to HEAL_ROUNDS total within HEAL_ROUNDS_BUDGET_S. Only
+    install/build steps invalidated by each patch rerun. Returns the volatile
+    prompts of the rounds that were tried when tests pass, else [].
+    """
+    deadline = time.monotonic() + HEAL_ROUNDS_BUDGET_S
+    patches, prompts = [diff], []
+    for rnd in range(2, HEAL_ROUNDS + 1):
+        if time.monotonic() >= deadline:
+            print(f"repair budget ({HEAL_ROUNDS_BUDGET_S:.0f}s) spent before round {rnd}")
+            break
+        print(f"repair round {rnd}/{HEAL_ROUNDS}")
+        prompt = repair_prompt(suffix, patches, warm.output)
+        try:
+            follow_up = extract_diff_block(vertex_try(prompt, prefix=prefix, model_name=model_name))
+        except (Exception, SystemExit) as e:
+            print(f"round {rnd}: generation failed: {e}")
+            break
+        if not follow_up:
+            print(f"round {rnd}: no diff block returned")
+            break
+        if not apply_patch(follow_up):
+            print(f"round {rnd}: follow-up patch failed to apply")
+            break
+        patches.append(follow_up)
+        prompts.append(prompt)
+        warm.invalidate(diff_paths(follow_up))
+        started = time.monotonic()
+        ok = run_tests(warm=warm)
+        print(f"round {rnd}: tests {'passed' if ok else 'failed'} in {time.monotonic() - started:.1f}s")
+        if ok:
+            return prompts
+    return []
+
+
+# -------- model cascade
+
+# Comma-separated "model[:budget_tokens]" tiers, cheapest first, e.g.
+# "gemini-1.5-flash:60000,gemini-1.5-pro". A tier escalates to the next when
+# its diff is missing, does not apply, or leaves tests failing. Unset: the
+# default model alone with its full budget.
+HEAL_MODEL_CASCADE = os.environ.get("HEAL_MODEL_CASCADE", "")
+HEAL_CASCADE_FILE = os.environ.get("HEAL_CASCADE_FILE", str(CILOG_DIR / "heal-cascade.json"))
+CASCADE_RESULTS: List[dict] = []
+
+
+def cascade_tiers() -> List[Tuple[str, int]]:
+    tiers = []
+    for item in HEAL_MODEL_CASCADE.split(","):
+        name, _, cap = item.strip().partition(":")
+        if name:
+            tiers.append((name, int(cap or 0)))
+    return tiers or [(default_model_name(), 0)]
+
+
+def build_heal_prompt(model_name: str, cap: int, deploy_block: str, pod_text: str, level: int = 0) -> Tuple[str, str]:
+    """(prefix, suffix) for one model within `cap` tokens (0: the model's full budget), at a shrink level."""
+    budget = PromptBudget.for_model(model_name, cap).shrunk(1 - level / PROMPT_SHRINK_LEVELS)
+    deploy_block = budget.spend("deploy", deploy_block)
+    # pod logs double as failure anchors for the focus section
+    # stable prefix (rules + snapshot at the tree hash) first, volatile findings last
+    prefix, suffix = build_prompt_parts(budget, anchor_text=pod_text)
+    PROMPT_SECTIONS.clear()
+    PROMPT_SECTIONS.update(budget.used)
+    return HEAL_SYSTEM_PROMPT + "\n\n" + prefix, suffix + deploy_block
+
+
+class PromptFitter:
+    """
+    The least-shrunk build_heal_prompt() level that fits a model's input limit.
+    The limit starts as the model's window, checked against our token estimate
+    (no model call), and is recalibrated each time the model rejects a prompt
+    as too long. Thread-safe: concurrent candidates share one fitter.
+    """
+
+    def __init__(self, model_name: str, cap: int, deploy_block: str, pod_text: str):
+        self.model_name = model_name
+        self.cap = cap
+        self.deploy_block = deploy_block
+        self.pod_text = pod_text
+        self.limit = model_context_tokens(model_name)
+        self.floor = 0  # levels below this were rejected by the model
+        self._built: dict = {}
+        self._level: int | None = None
+        self._lock = threading.Lock()
+
+    def _build(self, level: int) -> Tuple[str, str]:
+        if level not in self._built:
+            prefix, suffix = build_heal_prompt(self.model_name, self.cap, self.deploy_block, self.pod_text, level)
+            self._built[level] = (prefix, suffix, dict(PROMPT_SECTIONS))
+        return self._built[level][:2]
+
+    def _fits(self, level: int) -> bool:
+        prefix, suffix = self._build(level)
+        return estimate_tokens(prefix) + estimate_tokens(suffix) <= self.limit
+
+    def fit(self) -> Tuple[str, str, int]:
+        """(prefix, suffix, level) to send now; raises PromptTooLong when no level fits."""
+        with self._lock:
+            if self._level is None:
+                lo, top = self.floor, PROMPT_SHRINK_LEVELS - 1
+                if lo > top:
+                    raise PromptTooLong(f"no shrink level fits {self.model_name}'s ~{self.limit}-token input limit")
+                if not self._fits(lo):
+                    # fits() only improves with the level, so bisect (lo, top] for the first that fits
+                    if not self._fits(top):
+                        raise PromptTooLong(f"no shrink level fits {self.model_name}'s ~{self.limit}-token input limit")
+                    hi = top
+                    while hi - lo > 1:
+                        mid = (lo + hi) // 2
+                        if self._fits(mid):
+                            hi = mid
+                        else:
+                            lo = mid
+                    lo = hi
+                self._level = lo
+                if lo:
+                    print(f"prompt shrunk to level {lo}/{PROMPT_SHRINK_LEVELS} to fit {self.model_name}")
+            PROMPT_SECTIONS.clear()
+            PROMPT_SECTIONS.update(self._built[self._level][2])
+            return self._built[self._level][:2] + (self._level,)
+
+    def rejected(self, level: int, e: PromptTooLong) -> None:
+        """The model turned away the prompt at `level`: calibrate the limit and look further down."""
+        with self._lock:
+            if level != self._level:
+                return  # another caller already re-fitted past it
+            prefix, suffix = self._built[level][:2]
+            # the model counts differently from our estimate
+            sent = estimate_tokens(prefix) + estimate_tokens(suffix)
+            self.limit = min(self.limit, int(sent * e.ratio * 0.98) if e.ratio else sent - 1)
+            print(f"{self.model_name} rejected the prompt at level {level} as too long; limit now ~{self.limit} tokens")
+            self.floor = level + 1
+            self._level = None
+
+
+def generate_fitted(model_name: str, cap: int, deploy_block: str, pod_text: str) -> Tuple[str, str, str, int]:
+    """
+    build_heal_prompt() + vertex_try(), at the least-shrunk level a PromptFitter
+    finds to fit the model, moving down when the model still rejects it.
+    Returns (prefix, suffix, raw response, shrink level).
+    """
+    fitter = PromptFitter(model_name, cap, deploy_block, pod_text)
+    while True:
+        prefix, suffix, level = fitter.fit()
+        try:
+            return prefix, suffix, vertex_try(suffix, prefix=prefix, model_name=model_name), level
+        except PromptTooLong as e:
+            fitter.rejected(level, e)
+
+
+def git_paths(args: List[str], root: Path = ROOT) -> set:
+    code, out = run_cap(["git"] + args + ["-z"], cwd=root)
+    return set(filter(None, out.split("\0"))) if code == 0 else set()
+
+
+def revert_tree(untracked_before: set, warm: WarmState) -> None:
+    """Undo a failed tier (tracked edits and files it created) and invalidate the warm steps it touched."""
+    changed = git_paths(["diff", "--name-only", "HEAD"])
+    added = git_paths(["ls-files", "--others", "--exclude-standard"]) - untracked_before
+    run(["git", "reset", "-q", "--hard", "HEAD"], check=False)
+    for rel in added:
+        (ROOT / rel).unlink(missing_ok=True)
+    warm.invalidate(changed | added)
+
+
+def heal_tier(index: int, model_name: str, cap: int, deploy_block: str, pod_text: str, warm: WarmState) -> dict:
+    """
+    One cascade tier: prompt, generate, apply, test (plus repair rounds).
+    Returns its record; outcome "healed" leaves the fix in the tree, and
+    exit_code is what main() exits with if this is the last tier.
+    """
+    started = time.monotonic()
+    rec = {"tier": index, "model": model_name, "budget_tokens": cap or None}
+    print(f"tier {index}: {model_name}")
+    try:
+        prefix, suffix, raw, rec["shrink_level"] = generate_fitted(model_name, cap, deploy_block, pod_text)
+        rec["prompt_tokens_est"] = sum(PROMPT_SECTIONS.values())
+        diff = extract_diff_block(raw)
+    except SystemExit as e:
+        print("Vertex generation failed.")
+        rec.update(outcome="generate-failed", exit_code=e.code)
+    except Exception as e:
+        print(f"Vertex call failed unexpectedly: {e}")
+        rec.update(outcome="generate-failed", exit_code=5)
+    else:
+        if not diff:
+            print("No diff block returned by model.")
+            rec.update(outcome="no-diff", exit_code=2)
+        elif not apply_patch(diff):
+            print("Patch failed to apply.")
+            rec.update(outcome="apply-failed", exit_code=3)
+        else:
+            # with HEAL_ROUNDS>1 failing output goes back for follow-up patches
+            rounds: List[str] = []
+            # warm is shared across tiers: an earlier tier's install/build may predate this patch
+            warm.invalidate(diff_paths(diff))
+            ok = run_tests(warm=warm)
+            if not ok and HEAL_ROUNDS > 1:
+                rounds = repair_rounds(prefix, suffix, diff, warm, model_name)
+                ok = bool(rounds)
+            if ok:
+                # only the last response was tested as part of a passing tree; earlier
+                # rounds' patches failed on their own, and a repair prompt embeds them
+                llm_cache_mark_validated(llm_cache_key(model_name, prefix, (rounds or [suffix])[-1]))
+                rec.update(outcome="healed", exit_code=0, rounds=1 + len(rounds))
+            else:
+                print("Tests still failing after patch.")
+                rec.update(outcome="tests-failed", exit_code=4)
+    rec["seconds"] = round(time.monotonic() - started, 3)
+    CASCADE_RESULTS.append(rec)
+    if HEAL_CASCADE_FILE:
+        try:
+            path = Path(HEAL_CASCADE_FILE)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(json.dumps(CASCADE_RESULTS, indent=2), encoding="utf-8")
+        except OSError as e:
+            print(f"could not write {HEAL_CASCADE_FILE}: {e}")
+    return rec
 
 
 def main() -> None:
@@ -652,7 +3507,8 @@ def main() -> None:
         return  # Important: exit after investigation
       
     print("MCP_MANIFEST: mcp-server/vertex-orchestrator@poc (Vertex + fallbacks)")
-    for k in ("GCP_PROJECT_ID", "GCP_LOCATION", "VERTEX_MODEL"):
+    # offline backends (LLM_BACKEND=replay|synthetic) run without GCP settings
+    for k in ("GCP_PROJECT_ID", "GCP_LOCATION", "VERTEX_MODEL") if LLM_BACKEND == "vertex" else ():
         if not os.environ.get(k):
             print(f"Missing env {k}")
             raise SystemExit(6)
@@ -662,92 +3518,55 @@ def main() -> None:
     # 1) Build prompt from logs + code
     # --- optionally include deployment investigation into the LLM prompt ---
     # Controlled by env var INCLUDE_DEPLOY_INVESTIGATION=1 to avoid running in CI unintentionally.
-    prompt = build_llm_prompt()
+    tiers = cascade_tiers()
+    deploy_block, pod_text = "", ""
     if os.environ.get("INCLUDE_DEPLOY_INVESTIGATION") == "1":
-      try:
-          ns = os.environ.get("DEPLOY_NAMESPACE", "default")
-          sel = os.environ.get("DEPLOY_SELECTOR", "")
-          inv = investigate_deployment_failure(namespace=ns, selector=sel)
-  
-          # Save full JSON for artifacts/debugging
-          (ROOT / "ci-logs").mkdir(exist_ok=True)
-          (ROOT / "ci-logs" / "deploy-investigation.json").write_text(json.dumps(inv, indent=2), encoding="utf-8")
-  
-          # Create a concise human summary to append to the prompt (truncate to keep prompt small)
-          summary = []
-          failed = inv.get("failed_deployments", [])
-          if not failed:
-              summary.append("DEPLOYMENT INVESTIGATION: no failed deployments found.")
-          else:
-              for d in failed:
-                  info = inv["per_deployment"].get(d, {})
-                  imgs = info.get("images", [])
-                  summary.append(f"Deployment {d} failed. Images: " + ",".join([f"{n}:{i}" for n,i in imgs]))
-                  pods = info.get("pods", [])[:5]
-                  summary.append("  Pods: " + ",".join(pods) if pods else "  No pods found")
-                  # candidate commits (brief)
-                  cands = info.get("candidate_commits", [])[:3]
-                  for c in cands:
-                      if c.get("reason") == "image-sha" and c.get("commit"):
-                          cm = c["commit"]
-                          summary.append(f"  Candidate commit (image tag): {cm.get('hash')} - {cm.get('subject')}")
-                      elif c.get("reason") == "manifest-change":
-                          for cm in c.get("commits", [])[:2]:
-                              summary.append(f"  Manifest changed in {cm.get('hash')} - {cm.get('subject')}")
-          deploy_block = "\n".join(summary)
-          # Keep only first ~50k chars to avoid blowing up model context
-          prompt = prompt + "\n\nDEPLOYMENT INVESTIGATION SUMMARY:\n" + deploy_block[:50_000]
-  
-      except Exception as e:
-          prompt = prompt + f"\n\nDEPLOYMENT INVESTIGATION FAILED: {e}\n"
-    
-    # 2) Ask Vertex for a unified diff
-    try:
-        llm_raw = vertex_try(
-            textwrap.dedent("""
-            You are an expert DevOps+Software agent. You are given CI logs and code snapshots.
-            Return ONLY a unified diff patch inside a single ```diff fenced block``` that fixes the CI failure.
-            """) + "\n\n" + prompt
-        )
-        diff = extract_diff_block(llm_raw)
-    except SystemExit as e:
-        print("Vertex generation failed; trying fallback heuristics…")
-        if fallback_heuristics():
-            print("Fallback heuristics healed and pushed auto-fix branch.")
+        # sized for the largest tier; smaller tiers truncate it to their own allotment
+        deploy_block, pod_text = build_deploy_block(PromptBudget.for_model(tiers[-1][0], tiers[-1][1]).allot("deploy"))
+
+    # 2-4) Multi-candidate mode: N diffs generated and validated in parallel worktrees
+    if HEAL_CANDIDATES > 1:
+        winner, cands = heal_candidates(default_model_name(), deploy_block, pod_text, HEAL_CANDIDATES)
+        if winner and apply_patch(winner["diff"]):
+            push_autofix_branch()
+            print(f"Healed successfully with candidate #{winner['index']}, auto-fix branch pushed.")
             return
-        raise e
-    except Exception as e:
-        print(f"Vertex call failed unexpectedly: {e}")
-        print("Trying fallback heuristics…")
+        if any(c.get("applied") for c in cands):
+            print("Tests still failing for every candidate.")
+            raise SystemExit(4)
+        print("No candidate patch applied.")
         if fallback_heuristics():
             print("Fallback heuristics healed and pushed auto-fix branch.")
             return
-        raise SystemExit(5)
-
-    if not diff:
-        print("No diff block returned by model.")
-        if fallback_heuristics():
-            print("Fallback heuristics healed and pushed auto-fix branch.")
+        if all(c.get("error", "").startswith("generate") for c in cands):
+            raise SystemExit(5)
+        raise SystemExit(2 if not any(c.get("diff") for c in cands) else 3)
+
+    # 2-4) Ask each cascade tier for a diff, apply it and run tests; a failed
+    # tier is reverted (keeping node_modules warm) before the next one tries
+    if len(tiers) > 1 and git_paths(["diff", "--name-only", "HEAD"]):
+        print("Working tree has local changes; using only the last cascade tier so nothing gets reverted.")
+        tiers = tiers[-1:]
+    warm = WarmState()
+    untracked = git_paths(["ls-files", "--others", "--exclude-standard"])
+    for i, (model_name, cap) in enumerate(tiers, 1):
+        tier = heal_tier(i, model_name, cap, deploy_block, pod_text, warm)
+        if tier["outcome"] == "healed":
+            # 5) Push auto-fix branch
+            push_autofix_branch()
+            print(f"Healed successfully with {model_name}, auto-fix branch pushed.")
             return
-        raise SystemExit(2)
+        if i < len(tiers):
+            print(f"tier {i} ({model_name}): {tier['outcome']}; escalating")
+            revert_tree(untracked, warm)
 
-    # 3) Apply patch
-    if not apply_patch(diff):
-        print("Patch failed to apply.")
+    # the last tier failed: patched-but-failing trees exit as before, the rest try the heuristics
+    if tier["outcome"] != "tests-failed":
+        print("Trying fallback heuristics…")
         if fallback_heuristics():
             print("Fallback heuristics healed and pushed auto-fix branch.")
             return
-        raise SystemExit(3)
-
-    # 4) Run tests
-    if not run_tests():
-        print("Tests still failing after patch.")
-        raise SystemExit(4)
-
-    # 5) Push auto-fix branch
-    push_autofix_branch()
-    print("Healed successfully, auto-fix branch pushed.")
-
+    raise SystemExit(tier["exit_code"])
 
 if __name__ == "__main__":
     main()
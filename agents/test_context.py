@@ -0,0 +1,188 @@
+"""Tests for prompt context gathering: python -m unittest discover -s agents"""
+
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import mcp_server as m
+
+
+class TreeTest(unittest.TestCase):
+    """Runs against a throwaway tree as ROOT, listed by the filesystem walk with the blob cache off."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        patcher = mock.patch.multiple(m, ROOT=self.root, CONTEXT_DISCOVERY="walk", CONTEXT_CACHE_DIR="off")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, rel: str, text: str) -> None:
+        path = self.root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding="utf-8")
+
+
+class DiscoveryTest(TreeTest):
+    FILES = ["package.json", "app/package.json", "app/src/package.json", "app/src/index.js", "app/src/util/a.ts",
+             "app/src/b.jsx", "app/README.md", "app/data/c.yml", "lib/app/x.js", "README.md", "docs/README.md",
+             "agents/a.py", "agents/sub/b.py", ".github/workflows/ci.yml", ".github/workflows/sub/no.yml",
+             "k8s/base/d.yaml", "Dockerfile", "app/Dockerfile", "other.txt", "app/src/util/z.js"]
+
+    def setUp(self):
+        super().setUp()
+        for rel in self.FILES:
+            self.write(rel, "x\n")
+
+    def rglob_groups(self) -> list:
+        """One rglob per pattern, as before: per-pattern sets in pattern order, earlier patterns win."""
+        seen: set = set()
+        groups = []
+        for patt in m.CONTEXT_PATTERNS:
+            group = {p.relative_to(self.root) for p in self.root.rglob(patt) if p.is_file()} - seen
+            seen |= group
+            groups.append(group)
+        return groups
+
+    def test_matches_per_pattern_rglob(self):
+        found = m.match_files(m.walk_files(self.root), m.CONTEXT_PATTERNS)
+        self.assertEqual(len(found), len(set(found)))
+        # same files, bucketed in pattern order (rglob's order within a pattern is the filesystem's)
+        groups = self.rglob_groups()
+        self.assertEqual(found, [p for p in found if any(p in g for g in groups)])
+        self.assertEqual([set(found[sum(map(len, groups[:i])):][:len(g)]) for i, g in enumerate(groups)], groups)
+
+    def test_prunes_vendored_dirs(self):
+        expected = sum(map(len, self.rglob_groups()))
+        self.write("app/node_modules/pkg/index.js", "x\n")
+        self.write("node_modules/pkg/package.json", "x\n")
+        found = m.match_files(m.walk_files(self.root), m.CONTEXT_PATTERNS)
+        self.assertEqual(len(found), expected)
+        self.assertFalse([p for p in found if "node_modules" in p.parts])
+
+
+class FocusTest(TreeTest):
+    def setUp(self):
+        super().setUp()
+        for i in range(10):
+            self.write(f"app/a/f{i}.js", "// filler\n" * 1400)
+        self.write("app/api/server.js", 'const x = 1;\nthrow new Error("boom");\n' + "// pad\n" * 2000)
+        self.anchors = m.extract_anchors("at app/api/server.js:2:5")
+
+    def test_snapshot_ignores_the_failure(self):
+        shown: set = set()
+        code = m.read_code_context(26000, shown)
+        self.assertNotIn("app/api/server.js", shown)
+        self.assertEqual(code, m.read_code_context(26000))
+
+    def test_cited_file_left_out_of_snapshot_is_focused(self):
+        shown: set = set()
+        m.read_code_context(26000, shown)
+        focus = m.read_focus_context(self.anchors, 50000, shown)
+        self.assertTrue(focus.startswith("RANKING: app/api/server.js (lines 2)\n"))
+        self.assertIn("=== app/api/server.js ===\nconst x = 1;", focus)
+
+    def test_tight_focus_budget_falls_back_to_anchored_units(self):
+        focus = m.read_focus_context(self.anchors, 50, set())
+        self.assertIn("[lines 2-2]\nthrow new Error", focus)
+        self.assertNotIn("// pad", focus)
+
+    def test_file_shown_in_full_is_only_ranked(self):
+        focus = m.read_focus_context(self.anchors, 50000, {"app/api/server.js"})
+        self.assertEqual(focus, "RANKING: app/api/server.js (lines 2)\n")
+
+
+class LogTest(TreeTest):
+    def test_redrawn_progress_line_is_read_in_bounded_pieces(self):
+        self.write("ci.log", "start\n" + "".join(f"\rbuilding {i}" for i in range(50_000)) + "\nerror: boom\n")
+        with mock.patch.multiple(m, LOG_READ_CHUNK=4096, LOG_LINE_MAX_CHARS=100):
+            with open(self.root / "ci.log", encoding="utf-8", newline="\n") as f:
+                lines = list(m._bounded_lines(f, {}))
+            out = m.read_condensed_log(self.root / "ci.log", 1000, 1000)
+        self.assertEqual(lines, ["start\n", "building 49999\n", "error: boom\n"])
+        self.assertEqual(out, "start\nbuilding 49999\nerror: boom\n")
+
+    def test_long_line_is_capped(self):
+        self.write("ci.log", "x" * 10_000 + "\nok\n")
+        with mock.patch.multiple(m, LOG_READ_CHUNK=512, LOG_LINE_MAX_CHARS=100):
+            out = m.read_condensed_log(self.root / "ci.log", 1000, 1000)
+        self.assertEqual(out, "x" * 100 + "\nok\n")
+
+    def test_repeats_collapse_to_the_first_original_line(self):
+        lines = [f"2024-05-01T12:00:0{i}.000Z retry {i}s: GET /api took {10 + i}ms" for i in range(3)] + ["done"]
+        out = list(m.condense_lines(lines))
+        # the leading timestamp is stripped; the rest of the first line survives verbatim
+        self.assertEqual(out[0], "retry 0s: GET /api took 10ms (x3)")
+        self.assertEqual(out[1:], ["done"])
+
+    def test_different_lines_are_not_collapsed(self):
+        out = list(m.condense_lines(["retry 1 of 3", "retry 2 of 3", "retry 2 of 3"]))
+        self.assertEqual(out, ["retry 1 of 3", "retry 2 of 3 (x2)"])
+
+    def test_long_stack_runs_are_folded(self):
+        frames = [f"    at f{i} (app/src/a.js:{i}:1)" for i in range(12)]
+        with mock.patch.object(m, "LOG_STACK_KEEP", 3):
+            out = list(m.condense_lines(["Error: boom"] + frames + ["next"] + frames[:2]))
+        self.assertEqual(out, ["Error: boom"] + frames[:3] + ["    ... 9 more frames", "next"] + frames[:2])
+
+    def test_noise_is_dropped(self):
+        noise = ["npm WARN deprecated glob@7.2.3: old", "npm notice New major version", "##[group]Run npm ci",
+                 "[##########          ] 50%", "Downloading layer 3f2a 45%", "\x1b[32m##[endgroup]\x1b[0m"]
+        out = list(m.condense_lines(noise[:3] + ["npm WARN config production"] + noise[3:] + ["Error: boom"]))
+        self.assertEqual(out, ["npm WARN config production", "Error: boom"])
+
+
+JUNIT = """<?xml version="1.0" encoding="UTF-8"?>
+<testsuites>
+  <testsuite name="api" tests="4">
+    <testcase classname="api.server" name="responds" time="0.01"/>
+    <testcase classname="api.server" name="handles errors" time="0.25">
+      <failure message="expected 200">AssertionError: expected 500 to be 200
+    at Object.&lt;anonymous&gt; (app/src/server.test.js:12:5)  </failure>
+    </testcase>
+    <testcase classname="api.db" name="connects" time="1.5">
+      <error message="ECONNREFUSED"/>
+    </testcase>
+    <testcase classname="api.db" name="skipped one"><skipped/></testcase>
+  </testsuite>
+</testsuites>
+"""
+
+
+class JUnitTest(TreeTest):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.multiple(m, APP_DIR=self.root / "app", CILOG_DIR=self.root / "ci-logs")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_keeps_only_failures_and_errors(self):
+        self.write("app/junit.xml", JUNIT)
+        self.assertEqual(m.parse_junit_failures(self.root / "app/junit.xml"), [
+            {"kind": "failure", "classname": "api.server", "name": "handles errors", "time": "0.25",
+             "message": "expected 200\nAssertionError: expected 500 to be 200\n"
+                        "    at Object.<anonymous> (app/src/server.test.js:12:5)"},
+            {"kind": "error", "classname": "api.db", "name": "connects", "time": "1.5", "message": "ECONNREFUSED"},
+        ])
+
+    def test_message_is_trimmed(self):
+        self.write("app/junit.xml", JUNIT.replace("expected 200", "x" * 100))
+        with mock.patch.object(m, "JUNIT_MESSAGE_CHARS", 40):
+            failures = m.parse_junit_failures(self.root / "app/junit.xml")
+        self.assertEqual(failures[0]["message"], "x" * 40)
+
+    def test_failures_are_deduplicated_across_reports(self):
+        self.write("app/junit.xml", JUNIT)
+        self.write("ci-logs/shard-1/junit.xml", JUNIT)
+        self.write("ci-logs/notes.xml", "<notes/>")
+        out = m.read_failures()
+        self.assertEqual(out.count("api.server :: handles errors"), 1)
+        self.assertEqual(out.splitlines()[0], "- [failure] api.server :: handles errors (0.25s)")
+        self.assertIn("- [error] api.db :: connects (1.5s)\n    ECONNREFUSED", out)
+        self.assertNotIn("responds", out)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""Tests for diff extraction from model replies: python -m unittest discover -s agents"""
+
+import random
+import unittest
+
+import mcp_server as m
+
+HUNK = "--- a/x.js\n+++ b/x.js\n@@ -1,2 +1,2 @@\n a\n-b\n+c\n"
+
+
+def stream(text: str, size: int = 7):
+    """(opened, cancelled, chars read) for text streamed through DiffStreamScanner in size-char chunks."""
+    sc = m.DiffStreamScanner()
+    for i in range(0, len(text), size):
+        if sc.feed(text[i:i + size]):
+            return sc.opened, True, len(sc.text)
+    return sc.opened, False, len(sc.text)
+
+
+class ScanTest(unittest.TestCase):
+    def scan(self, text):
+        return [(b.source, b.files, b.confidence) for b in m.scan_diff_blocks(text)]
+
+    def test_fences_and_bare(self):
+        self.assertEqual(self.scan(f"Fix:\n```diff\n{HUNK}```\nDone."), [("fence:diff", ["x.js"], 0.95)])
+        self.assertEqual(self.scan(f"```patch\n{HUNK}```"), [("fence:patch", ["x.js"], 0.95)])
+        self.assertEqual(self.scan(f"diff --git a/x.js b/x.js\nindex 1..2 100644\n{HUNK}Thanks"),
+                         [("bare", ["x.js"], 0.65)])
+
+    def test_counted_hunk_ends_bare_diff_before_prose(self):
+        self.assertEqual(m.extract_diff_block(HUNK + "- This bullet is prose\n"), HUNK.strip())
+
+    def test_indented_fence_is_context(self):
+        text = "```diff\n--- a/z.md\n+++ b/z.md\n@@ -1,3 +1,3 @@\n ```\n-old\n+new\n```\n"
+        self.assertIn(" ```\n-old\n+new", m.extract_diff_block(text))
+
+    def test_nested_fence(self):
+        text = f"````markdown\nexample:\n```diff\n{HUNK}```\n````"
+        self.assertEqual(self.scan(text), [("fence:diff", ["x.js"], 0.95)])
+
+    def test_split_blocks_merge_per_file(self):
+        text = (f"```diff\n{HUNK}```\nand\n```diff\n--- a/y.js\n+++ b/y.js\n@@ -5 +5 @@\n-q\n+r\n```\n"
+                "more:\n```diff\n--- a/x.js\n+++ b/x.js\n@@ -10,1 +10,1 @@\n-k\n+K\n```")
+        out = m.extract_diff_block(text)
+        self.assertEqual(out.count("+++ b/x.js"), 1)
+        self.assertLess(out.index("@@ -10,1"), out.index("+++ b/y.js"))
+
+    def test_revised_hunk_keeps_later_version(self):
+        text = f"```diff\n{HUNK}```\nCorrection:\n```diff\n{HUNK.replace('+c', '+C')}```"
+        self.assertEqual(m.extract_diff_block(text), HUNK.replace("+c", "+C").strip())
+
+    def test_truncated_blocks_refused(self):
+        self.assertEqual(m.extract_diff_block("```diff\n--- a/x\n+++ b/x\n@@ -1,4 +1,1 @@\n-a\n-b\n"), "")
+        self.assertEqual(m.extract_diff_block("```diff\n--- a/x\n+++ b/x\n@@\n-a\n-b\n"), "")
+
+    def test_bare_hunk_stops_at_prose(self):
+        text = "--- a/x\n+++ b/x\n@@\n a\n-b\n+c\n\n- This removes foo from the list.\n"
+        self.assertEqual(m.extract_diff_block(text), "--- a/x\n+++ b/x\n@@\n a\n-b\n+c")
+        glued = "--- a/x\n+++ b/x\n@@\n a\n-b\n+c\n- This removes foo from the list.\n"
+        self.assertEqual(m.extract_diff_block(glued), "")
+
+    def test_empty(self):
+        self.assertEqual(m.extract_diff_block("```diff\n```"), "")
+        self.assertEqual(m.extract_diff_block(""), "")
+
+    def test_fuzz(self):
+        frags = ["```", "```diff", "````", "```patch", "~~~", "diff --git a/x b/x", "--- a/x", "+++ b/x",
+                 "--- /dev/null", "+++ /dev/null", "@@", "@@ -1,2 +1,3 @@", "@@ -0,0 +1 @@", " ctx", "-old",
+                 "+new", "", "\\ No newline at end of file", "prose text", "- This is a bullet point",
+                 "index abc..def", "new file mode 100644", " ```", "@@ -x +y @@", "\t", "`", "+++", "---"]
+        rnd = random.Random(7)
+        for _ in range(5000):
+            text = "\n".join(rnd.choice(frags) for _ in range(rnd.randint(0, 40)))
+            m.extract_diff_block(text)
+            for b in m.scan_diff_blocks(text):
+                self.assertTrue(0 <= b.confidence <= 1)
+                self.assertTrue(b.sections and all(key for key in b.files))
+            stream(text, rnd.randint(1, 16))
+
+
+class StreamTest(unittest.TestCase):
+    TAIL = "\nThis explanation keeps going for a while." * 200
+
+    def test_cuts_after_patch_fence_and_bare_diff(self):
+        for reply in (f"```patch\n{HUNK}```\n", f"diff --git a/x.js b/x.js\n{HUNK}"):
+            opened, cancelled, read = stream(reply + self.TAIL)
+            self.assertTrue(opened and cancelled)
+            self.assertLess(read, len(reply + self.TAIL))
+            self.assertTrue(m.extract_diff_block((reply + self.TAIL)[:read]).endswith(HUNK.strip()))
+
+    def test_indented_fence_does_not_cut_mid_hunk(self):
+        reply = "```diff\n--- a/x.md\n+++ b/x.md\n@@ -1,3 +1,3 @@\n ```\n-b\n+c\n```\n"
+        opened, cancelled, read = stream(reply + self.TAIL)
+        self.assertTrue(cancelled)
+        self.assertGreaterEqual(read, len(reply))
+
+    def test_waits_for_a_second_block(self):
+        reply = f"```diff\n{HUNK}```\nAlso:\n```diff\n--- a/y\n+++ b/y\n@@ -1 +1 @@\n-q\n+r\n```\n"
+        opened, cancelled, read = stream(reply + self.TAIL)
+        self.assertTrue(cancelled)
+        self.assertIn("+++ b/y", m.extract_diff_block((reply + self.TAIL)[:read]))
+
+    def test_text_and_tokens_track_the_chunks(self):
+        sc = m.DiffStreamScanner()
+        reply = "x" * 5000 + "\n```diff\n" + HUNK
+        for i in range(0, len(reply), 3):
+            sc.feed(reply[i:i + 3])
+        self.assertEqual(sc.text, reply)
+        self.assertEqual(sc.tokens, m.estimate_tokens(reply))
+        self.assertTrue(sc.scanner.in_diff)
+
+
+if __name__ == "__main__":
+    unittest.main()
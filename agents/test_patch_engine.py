@@ -0,0 +1,109 @@
+"""Tests for the in-process patch engine: python -m unittest discover -s agents"""
+
+import tempfile
+import unittest
+from pathlib import Path
+
+import mcp_server as m
+
+
+class ParseTest(unittest.TestCase):
+    def test_bare_headers_and_prefixes(self):
+        (fp,) = m.parse_unified_diff("--- a/x.js\n+++ b/x.js\n@@\n a\n-b\n+c\n")
+        self.assertEqual(fp.path, "x.js")
+        self.assertEqual(fp.hunks[0].old_start, 0)
+        self.assertEqual(fp.hunks[0].lines, [(" ", "a"), ("-", "b"), ("+", "c")])
+
+    def test_blank_context_and_trailing_gap(self):
+        (fp,) = m.parse_unified_diff("--- x\n+++ x\n@@ -1,3 +1,3 @@\n a\n\n-b\n+c\n\n")
+        self.assertEqual(fp.hunks[0].lines, [(" ", "a"), (" ", ""), ("-", "b"), ("+", "c")])
+
+    def test_no_newline_marker(self):
+        (fp,) = m.parse_unified_diff("--- x\n+++ x\n@@ -1 +1 @@\n-a\n\\ No newline at end of file\n+b\n")
+        self.assertTrue(fp.hunks[0].old_noeol)
+        self.assertFalse(fp.hunks[0].new_noeol)
+
+    def test_unsupported_and_empty(self):
+        with self.assertRaises(m.PatchError):
+            m.parse_unified_diff("diff --git a/x b/x\nBinary files a/x and b/x differ\n")
+        with self.assertRaises(m.PatchError):
+            m.parse_unified_diff("no diff here\n")
+
+
+class PatchTextTest(unittest.TestCase):
+    LINES = "".join(f"{c}\n" for c in "abcdefg")
+
+    def patch(self, text: str, diff: str) -> str:
+        (fp,) = m.parse_unified_diff(diff)
+        return m.patch_text(text, fp)
+
+    def test_exact(self):
+        out = self.patch(self.LINES, "--- x\n+++ x\n@@ -2,3 +2,3 @@\n b\n-c\n+C\n d\n")
+        self.assertEqual(out, self.LINES.replace("c\n", "C\n"))
+
+    def test_drifted_line_numbers(self):
+        out = self.patch(self.LINES, "--- x\n+++ x\n@@ -40,3 +40,3 @@\n e\n-f\n+F\n g\n")
+        self.assertEqual(out, self.LINES.replace("f\n", "F\n"))
+
+    def test_nearest_of_repeated_blocks(self):
+        text = "x\ny\nz\n" * 3
+        out = self.patch(text, "--- x\n+++ x\n@@ -4,3 +4,3 @@\n x\n-y\n+Y\n z\n")
+        self.assertEqual(out, "x\ny\nz\nx\nY\nz\nx\ny\nz\n")
+
+    def test_whitespace_fuzz_keeps_file_whitespace(self):
+        out = self.patch("  a\nb\n  c\n", "--- x\n+++ x\n@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n")
+        self.assertEqual(out, "  a\nB\n  c\n")
+
+    def test_context_fuzz(self):
+        out = self.patch(self.LINES, "--- x\n+++ x\n@@ -1,4 +1,4 @@\n WRONG\n a\n-b\n+B\n c\n")
+        self.assertEqual(out, self.LINES.replace("b\n", "B\n"))
+
+    def test_zero_length_old_range_inserts_after_line(self):
+        out = self.patch(self.LINES, "--- x\n+++ x\n@@ -3,0 +4,1 @@\n+NEW\n")
+        self.assertEqual(out, "a\nb\nc\nNEW\nd\ne\nf\ng\n")
+
+    def test_crlf_preserved(self):
+        out = self.patch("one\r\ntwo\r\n", "--- x\n+++ x\n@@ -1,2 +1,2 @@\n one\n-two\n+TWO\n")
+        self.assertEqual(out, "one\r\nTWO\r\n")
+
+    def test_no_newline_at_end(self):
+        out = self.patch("last", "--- x\n+++ x\n@@ -1 +1,2 @@\n-last\n\\ No newline at end of file\n+last\n+more\n")
+        self.assertEqual(out, "last\nmore\n")
+
+    def test_unplaceable_hunk(self):
+        with self.assertRaises(m.PatchError) as ctx:
+            self.patch(self.LINES, "--- x\n+++ x\n@@ -1,2 +1,2 @@\n-nope\n+zz\n")
+        self.assertIn("hunk #1", ctx.exception.reasons[0])
+
+
+class ApplyInProcessTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp.name)
+        (self.root / "f.txt").write_text("a\nb\nc\n", encoding="utf-8")
+        (self.root / "g.txt").write_text("x\n", encoding="utf-8")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_new_and_deleted_files(self):
+        diff = ("--- /dev/null\n+++ b/sub/new.txt\n@@ -0,0 +1,2 @@\n+hello\n+world\n"
+                "--- a/g.txt\n+++ /dev/null\n@@ -1 +0,0 @@\n-x\n")
+        self.assertEqual(m.apply_in_process(diff, self.root), ["g.txt", "sub/new.txt"])
+        self.assertEqual((self.root / "sub/new.txt").read_text(encoding="utf-8"), "hello\nworld\n")
+        self.assertFalse((self.root / "g.txt").exists())
+
+    def test_all_or_nothing(self):
+        diff = ("--- g.txt\n+++ g.txt\n@@ -1 +1 @@\n-x\n+y\n"
+                "--- f.txt\n+++ f.txt\n@@ -1 +1 @@\n-nope\n+zz\n")
+        with self.assertRaises(m.PatchError):
+            m.apply_in_process(diff, self.root)
+        self.assertEqual((self.root / "g.txt").read_text(encoding="utf-8"), "x\n")
+
+    def test_path_escape_refused(self):
+        with self.assertRaises(m.PatchError):
+            m.apply_in_process("--- ../x\n+++ ../x\n@@ -1 +1 @@\n-a\n+b\n", self.root)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Tests for sandbox pooling and multi-candidate healing: python -m unittest discover -s agents"""
+
+import functools
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import mcp_server as m
+
+
+def git(root: Path, *args: str) -> str:
+    return subprocess.run(["git", *args], cwd=root, check=True, capture_output=True, text=True).stdout
+
+
+class RepoTest(unittest.TestCase):
+    """A throwaway git repo with an app/ package, committed."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = Path(self.tmp.name)
+        for rel, text in {"app/package.json": "{}\n", "app/src/index.js": "bad\n", "README.md": "x\n"}.items():
+            (self.root / rel).parent.mkdir(parents=True, exist_ok=True)
+            (self.root / rel).write_text(text, encoding="utf-8")
+        git(self.root, "init", "-q")
+        git(self.root, "add", "-A")
+        git(self.root, "-c", "user.email=t@example.com", "-c", "user.name=t", "commit", "-qm", "base")
+        patcher = mock.patch.object(m, "print", lambda *a, **k: None, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def worktrees(self) -> int:
+        return git(self.root, "worktree", "list", "--porcelain").count("worktree ")
+
+    def pool(self, size: int) -> m.SandboxPool:
+        pool = m.SandboxPool(max_size=size, root=self.root)
+        self.addCleanup(pool.close)
+        return pool
+
+
+class SandboxPoolTest(RepoTest):
+    def test_acquire_blocks_at_max_size_and_reuses(self):
+        pool = self.pool(1)
+        first = pool.acquire()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+        waiter.start()
+        waiter.join(0.3)
+        self.assertTrue(waiter.is_alive())
+        pool.release(first)
+        waiter.join(5)
+        self.assertEqual(got, [first])
+        self.assertEqual(self.worktrees(), 2)
+
+    def test_reset_drops_edits_and_new_files_but_keeps_warm_dirs(self):
+        pool = self.pool(1)
+        with pool.sandbox() as sb:
+            (sb.path / "app/src/index.js").write_text("edited\n", encoding="utf-8")
+            (sb.path / "app/src/new.js").write_text("new\n", encoding="utf-8")
+            (sb.path / "app/node_modules/dep").mkdir(parents=True)
+            (sb.path / "app/node_modules/dep/index.js").write_text("dep\n", encoding="utf-8")
+        self.assertEqual((sb.path / "app/src/index.js").read_text(encoding="utf-8"), "bad\n")
+        self.assertFalse((sb.path / "app/src/new.js").exists())
+        self.assertTrue((sb.path / "app/node_modules/dep/index.js").exists())
+        self.assertEqual(sb.trials, 1)
+
+    def test_reset_invalidates_only_what_the_trial_touched(self):
+        pool = self.pool(1)
+        cases = [
+            ("app/src/index.js", True, False),       # source edit: rebuild, deps still installed
+            ("app/src/index.test.js", True, True),   # new test file: nothing to redo
+            ("app/package.json", False, False),      # manifest edit: reinstall and rebuild
+        ]
+        for rel, installed, built in cases:
+            with self.subTest(rel=rel):
+                with pool.sandbox() as sb:
+                    sb.warm.installed = sb.warm.built = True
+                    (sb.path / rel).write_text("changed\n", encoding="utf-8")
+                self.assertEqual((sb.warm.installed, sb.warm.built), (installed, built))
+
+    def test_close_removes_worktrees(self):
+        pool = self.pool(2)
+        a, b = pool.acquire(), pool.acquire()
+        pool.release(a)
+        pool.close()
+        self.assertFalse(a.path.exists() or b.path.exists())
+        self.assertEqual(self.worktrees(), 1)
+
+
+class HealCandidatesTest(RepoTest):
+    GOOD = "--- a/app/src/index.js\n+++ b/app/src/index.js\n@@ -1 +1 @@\n-bad\n+good\n"
+    WRONG = "--- a/app/src/index.js\n+++ b/app/src/index.js\n@@ -1 +1 @@\n-bad\n+worse\n"
+
+    def generate(self, prefix, suffix, model_name=None, generation_config=None):
+        temperature = generation_config["temperature"]
+        if temperature == 1.0:
+            time.sleep(10)  # a slow generation the winner must not wait for
+        if temperature == 0.6:
+            time.sleep(0.3)
+        return f"```diff\n{self.GOOD if temperature == 0.6 else self.WRONG}```\n"
+
+    def run_tests(self, root, cancel=None, warm=None):
+        if (root / "app/src/index.js").read_text(encoding="utf-8") == "good\n":
+            return True
+        # a failing suite that runs long in a child process unless cancelled
+        code, _ = m.run_cap(["bash", "-c", "sleep 10; exit 1"], cancel=cancel)
+        return code == 0
+
+    def test_first_pass_wins_without_waiting_for_losers(self):
+        with mock.patch.multiple(m, HEAL_CANDIDATE_TEMPERATURES=[0.2, 0.6, 1.0], HEAL_SANDBOXES=3,
+                                 generate_with_prefix=self.generate,
+                                 run_tests=self.run_tests, build_heal_prompt=lambda *a: ("prefix", "suffix"),
+                                 SandboxPool=functools.partial(m.SandboxPool, root=self.root)):
+            started = time.monotonic()
+            winner, cands = m.heal_candidates("gemini-1.5-pro", "", "", 3)
+            elapsed = time.monotonic() - started
+        self.assertEqual(winner["index"], 1)
+        self.assertLess(elapsed, 5)
+        self.assertFalse(cands[0]["passed"])  # its long test run was killed
+        self.assertNotIn("diff", cands[2])  # still generating when abandoned
+        self.assertEqual(self.worktrees(), 1)
+        self.assertEqual((self.root / "app/src/index.js").read_text(encoding="utf-8"), "bad\n")
+
+
+if __name__ == "__main__":
+    unittest.main()